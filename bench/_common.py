@@ -0,0 +1,102 @@
+# Общее для бенчмарков: импорт bot.py без реального окружения и синтетический каталог.
+# Запуск из корня репозитория: python bench/<скрипт>.py
+import os, sys, time, random, tempfile
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+# bot.py проверяет обязательные переменные при импорте; в сеть бенчмарки не ходят
+for k, v in {"BOT_TOKEN": "1:bench", "API_ID": "1", "API_HASH": "bench",
+             "OPENROUTER_API_KEY": "bench", "HF_TOKEN": "bench"}.items():
+    os.environ.setdefault(k, v)
+os.environ.setdefault("STATE_DIR", tempfile.mkdtemp(prefix="bench-state-"))
+sys.path.insert(0, ROOT)
+
+import bot  # noqa: E402
+
+BRANDS = ["ABB", "Schneider", "IEK", "Legrand", "Hager", "Siemens", "EKF", "Rexant", "DKC", "TDM"]
+AMPS = [6, 10, 16, 20, 25, 32, 40, 50, 63, 80, 100]
+SQMM = [1, 2, 4, 6, 10, 16, 25, 35, 50, 70, 95]
+
+def make_catalog(n, seed=1) -> list[dict]:
+    # товары в форме, которую дают парсеры: автоматы, кабель, пускатели с атрибутами
+    rnd = random.Random(seed); items = []
+    for i in range(n):
+        brand = rnd.choice(BRANDS); kind = i % 3
+        if kind == 0:
+            amp = rnd.choice(AMPS); curve = rnd.choice("BCD"); poles = rnd.choice((1, 2, 3))
+            name = f"Автоматический выключатель {brand} {poles}P {curve}{amp}А"
+            ptype, cat, sq, coil = "автомат", "Автоматы", None, None
+            attrs = {"Номинальный ток, А": str(amp), "Кривая": curve, "Полюсов": str(poles)}
+        elif kind == 1:
+            sq = rnd.choice(SQMM); cores = rnd.choice((2, 3, 4, 5))
+            name = f"Кабель ВВГнг-LS {cores}х{sq} мм² {brand}"
+            ptype, cat, amp, coil = "кабель", "Кабель", None, None
+            attrs = {"Сечение, мм²": str(sq), "Жил": str(cores)}
+        else:
+            amp = rnd.choice(AMPS[:8]); coil = rnd.choice((24, 110, 220, 380))
+            name = f"Пускатель {brand} {amp}А катушка {coil}В"
+            ptype, cat, sq = "пускатель", "Пускатели", None
+            attrs = {"Номинальный ток, А": str(amp), "Напряжение катушки, В": str(coil)}
+        items.append({
+            "id": f"{i:08d}-guid", "sku": f"{brand[:3].upper()}-{i:06d}", "name": name,
+            "type": ptype, "brand": brand, "category": cat,
+            "amp": amp, "sqmm": sq, "coil_v": coil, "ip": rnd.choice((None, 20, 54)),
+            "price": float(rnd.randint(100, 20000)), "stock": rnd.choice((None, 0, 5, 40)),
+            "image_url": "", "attrs": attrs,
+        })
+    return items
+
+def best_ms(fn, repeat=5) -> float:
+    best = float("inf")
+    for _ in range(repeat):
+        t = time.perf_counter(); fn(); best = min(best, time.perf_counter() - t)
+    return best * 1000
+
+# ── CommerceML 1С ──
+def cml_groups(top=50, mid=10, leaf=9) -> list:
+    # дерево групп как в выгрузке 1С: (Ид, Наименование, [дети]); по умолчанию 5050 групп
+    return [(f"g{a}", f"Раздел {a}", [
+                (f"g{a}-{b}", f"Подраздел {a}.{b}", [
+                    (f"g{a}-{b}-{c}", f"Группа {a}.{b}.{c}", []) for c in range(leaf)])
+                for b in range(mid)])
+            for a in range(top)]
+
+def _leaf_ids(groups) -> list:
+    out = []
+    for gid, _, kids in groups:
+        out.extend(_leaf_ids(kids) if kids else [gid])
+    return out
+
+def _write_groups(w, groups, depth):
+    pad = "  " * depth
+    for gid, name, kids in groups:
+        w(f"{pad}<Группа><Ид>{gid}</Ид><Наименование>{name}</Наименование>")
+        if kids:
+            w("<Группы>\n"); _write_groups(w, kids, depth + 1); w(f"{pad}</Группы>")
+        w("</Группа>\n")
+
+def cml_import_xml(f, goods, groups=None):
+    # import.xml: классификатор (если groups) и товары goods — range номеров товаров
+    rnd = random.Random(goods.start); w = f.write
+    leaves = _leaf_ids(groups or cml_groups())
+    w('<?xml version="1.0" encoding="UTF-8"?>\n<КоммерческаяИнформация ВерсияСхемы="2.10">\n')
+    if groups:
+        w("<Классификатор><Ид>cls</Ид><Группы>\n"); _write_groups(w, groups, 1); w("</Группы></Классификатор>\n")
+    w("<Каталог><Ид>cat</Ид><Товары>\n")
+    for i in goods:
+        brand = rnd.choice(BRANDS); amp = rnd.choice(AMPS)
+        w(f"<Товар><Ид>{i:08d}-guid</Ид><Артикул>{brand[:3].upper()}-{i:06d}</Артикул>"
+          f"<Наименование>Автоматический выключатель {brand} C{amp}А</Наименование>"
+          f"<Группы><Ид>{rnd.choice(leaves)}</Ид></Группы>"
+          f"<Изготовитель><Наименование>{brand}</Наименование></Изготовитель>"
+          f"<ЗначенияСвойств><ЗначенияСвойства><Наименование>Номинальный ток, А</Наименование><Значение>{amp}</Значение></ЗначенияСвойства>"
+          f"<ЗначенияСвойства><Наименование>Полюсов</Наименование><Значение>{rnd.choice((1, 2, 3))}</Значение></ЗначенияСвойства></ЗначенияСвойств>"
+          "</Товар>\n")
+    w("</Товары></Каталог>\n</КоммерческаяИнформация>\n")
+
+def cml_offers_xml(f, goods):
+    rnd = random.Random(-goods.start - 1); w = f.write
+    w('<?xml version="1.0" encoding="UTF-8"?>\n<КоммерческаяИнформация ВерсияСхемы="2.10">\n<ПакетПредложений><Предложения>\n')
+    for i in goods:
+        w(f"<Предложение><Ид>{i:08d}-guid</Ид><Цены><Цена><ЦенаЗаЕдиницу>{rnd.randint(100, 20000)},00</ЦенаЗаЕдиницу></Цена></Цены>"
+          f"<Количество>{rnd.choice((0, 3, 12))}</Количество></Предложение>\n")
+    w("</Предложения></ПакетПредложений>\n</КоммерческаяИнформация>\n")
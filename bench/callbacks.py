@@ -0,0 +1,62 @@
+# Диспетчер callback'ов: тысячи синтетических нажатий через callbacks_handler —
+# новые кнопки (cb/cb_slug) и кнопки старого формата из уже отправленных сообщений.
+# Telegram не нужен: bot.tg подменён заглушкой, cq — поддельный объект.
+# python bench/callbacks.py [пользователей] [товаров]
+import asyncio, sys, time
+from collections import Counter
+from _common import bot, make_catalog, best_ms
+
+class Obj:
+    def __init__(self, **kw): self.__dict__.update(kw)
+
+errors = []
+async def _answer(text=None, **kw):
+    if text == "Ошибка обработчика": errors.append(text)
+async def _send(*a, **kw): pass
+async def _tg(method, *a, **kw): pass
+
+def fake_cq(data, user):
+    msg = Obj(id=1000 + user, chat=Obj(id=user), edit_text=_send, reply_text=_send)
+    return Obj(data=data, answer=_answer, from_user=Obj(id=user), message=msg)
+
+def scenario(cat, pid):
+    # путь одного пользователя: категории → мастер → значение/пропуск/назад → бронь
+    return [
+        ("c", bot.cb("c", 1)), ("w", bot.cb("w", bot.cb_slug(cat))), ("wv", bot.cb("wv", 0, 0)),
+        ("wk", bot.cb("wk", 1)), ("wb", bot.cb("wb", 1)), ("r", bot.cb("r", bot.cb_slug(pid))),
+        ("n", bot.cb("n")), ("reserve", f"reserve:{pid}"), ("fw2start", f"fw2start:{bot.slugify(cat)}"),
+    ]
+
+async def run(users, cats, ids):
+    per_op, counts = Counter(), Counter()
+    t0 = time.perf_counter()
+    for u in range(users):
+        for op, data in scenario(cats[u % len(cats)], ids[u * 7 % len(ids)]):
+            t = time.perf_counter()
+            await bot.callbacks_handler(None, fake_cq(data, u))
+            per_op[op] += time.perf_counter() - t; counts[op] += 1
+    return time.perf_counter() - t0, per_op, counts
+
+def main():
+    users = int(sys.argv[1]) if len(sys.argv) > 1 else 2000
+    n = int(sys.argv[2]) if len(sys.argv) > 2 else 20000
+    items = make_catalog(n)
+    for i, it in enumerate(items):   # сотни категорий, как в выгрузке 1С, а не три
+        it["category"] = f"{it['category']} — серия {i % 300}"
+    bot._snapshot, _ = bot.apply_catalog(bot._snapshot, items)
+    bot.tg = _tg
+    cats = bot._snapshot.index["categories"]; ids = list(bot._snapshot.index["slot_by_id"])
+    total, per_op, counts = asyncio.run(run(users, cats, ids))
+    k = sum(counts.values())
+    assert not errors, f"обработчики упали {len(errors)} раз"
+    print(f"{k} callback'ов, {users} пользователей, {n} товаров: {total:.2f} с, {total / k * 1e6:.0f} мкс на нажатие")
+    for op in counts:
+        print(f"  {op:9} {per_op[op] / counts[op] * 1e6:8.1f} мкс")
+    # разбор слага категории: индекс cb_slug против прежнего перебора slugify по всем категориям
+    slug, old = bot.cb_slug(cats[-1]), bot.slugify(cats[-1])
+    t_new = best_ms(lambda: [bot.unslugify(slug) for _ in range(1000)])
+    t_old = best_ms(lambda: [next((c for c in cats if bot.slugify(c) == old), None) for _ in range(1000)])
+    print(f"категория по слагу ({len(cats)} категорий): перебор {t_old:.1f} мкс, индекс {t_new:.2f} мкс")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,27 @@
+# Разбор выгрузки 1С в форме реального обмена: 5050 вложенных групп, 100k товаров
+# и предложения к ним в одном ZIP-пакете. Печатает время разбора и скорость в товарах/с.
+# python bench/commerceml.py [число товаров]
+import os, sys, tempfile, time, zipfile
+from _common import bot, cml_groups, cml_import_xml, cml_offers_xml
+
+def main():
+    n = int(sys.argv[1]) if len(sys.argv) > 1 else 100000
+    groups = cml_groups()
+    with tempfile.TemporaryDirectory() as d:
+        imp = os.path.join(d, "import.xml"); off = os.path.join(d, "offers.xml"); pkg = os.path.join(d, "exchange.zip")
+        with open(imp, "w", encoding="utf-8") as f: cml_import_xml(f, range(n), groups)
+        with open(off, "w", encoding="utf-8") as f: cml_offers_xml(f, range(n))
+        with zipfile.ZipFile(pkg, "w", zipfile.ZIP_DEFLATED) as z: z.write(imp, "import.xml"); z.write(off, "offers.xml")
+        size = (os.path.getsize(imp) + os.path.getsize(off)) / 1048576
+        print(f"выгрузка: {n} товаров, 5050 групп, {size:.0f} МБ XML")
+
+        t = time.perf_counter(); bot.parse_commerceml(imp); t_imp = time.perf_counter() - t
+        t = time.perf_counter(); items = bot.parse_commerceml(pkg); t_pkg = time.perf_counter() - t
+
+    assert len(items) == n and all(p["category_path"].count(" / ") == 2 for p in items)
+    print(f"import.xml  {t_imp:6.2f} с   ({n / t_imp:,.0f} товаров/с, с группами)")
+    print(f"ZIP-пакет   {t_pkg:6.2f} с   (import + offers, слияние)")
+    print(f"пример: {items[0]['category']!r} ← {items[0]['category_path']!r}")
+
+if __name__ == "__main__":
+    main()
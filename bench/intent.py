@@ -0,0 +1,31 @@
+# Разбор намерения на длинных и враждебных сообщениях: прежняя регулярка INTENT
+# с ленивым .*? (квадратична на тексте без цифр) против словаря-дерева из каталога.
+# python bench/intent.py [длина сообщения, по умолчанию 20000]
+import sys
+from _common import bot, make_catalog, best_ms
+from search import old_parse_intent
+
+def inputs(n):
+    return {
+        "без цифр": "а" * n,
+        "слова без чисел": ("кабель медный гибкий " * n)[:n],
+        "число в конце": "з" * (n - 3) + " 16а",
+        "много чисел без единиц": ("12 34 56 " * n)[:n],
+        "бренды вперемешку": ("abbx iekx schneiderx " * n)[:n],
+        "обычный запрос": "автомат abb 16а",
+    }
+
+def main():
+    n = int(sys.argv[1]) if len(sys.argv) > 1 else 20000
+    snap, _ = bot.apply_catalog(bot._snapshot, make_catalog(3000))
+    print(f"длина сообщений: {n} символов")
+    print(f"{'вход':24} {'прежний, мс':>12} {'новый, мс':>10} {'из кэша, мс':>12}")
+    for name, text in inputs(n).items():
+        t_old = best_ms(lambda: old_parse_intent(text), repeat=1)
+        t_new = best_ms(lambda: (bot._intent_cache.clear(), bot.parse_intent(text, snap)), repeat=3)
+        bot.parse_intent(text, snap)
+        t_hit = best_ms(lambda: bot.parse_intent(text, snap), repeat=3)
+        print(f"{name:24} {t_old:12.1f} {t_new:10.2f} {t_hit:12.3f}")
+
+if __name__ == "__main__":
+    main()
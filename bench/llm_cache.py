@@ -0,0 +1,64 @@
+# Кэш и single-flight ответов LLM против локальной заглушки OpenRouter (bench/stub_upstream.py).
+# Поток первых вопросов с распределением Ципфа — немногие частые («что такое УЗО»,
+# часы работы) и длинный хвост; вопросы приходят с интервалом и перекрываются.
+# Без кэша каждый вопрос — запрос наверх, с кэшем — попадание или общий запрос.
+# python bench/llm_cache.py [вопросов] [разных вопросов] [интервал, мс] [задержка заглушки, с]
+# одновременная пачка (single-flight): python bench/llm_cache.py 500 50 0
+import os, sys, asyncio, random, time
+
+PORT = 8767
+os.environ["OR_CHAT_URL"] = f"http://127.0.0.1:{PORT}/v1/chat/completions"
+from _common import bot          # noqa: E402
+from stub_upstream import Stub   # noqa: E402
+
+def workload(n, distinct, seed=1):
+    rnd = random.Random(seed)
+    weights = [1 / (r + 1) for r in range(distinct)]
+    picks = rnd.choices(range(distinct), weights, k=n)
+    # разный регистр и пробелы — ключ кэша нормализует переписку
+    return [[{"role": "user", "content": rnd.choice(("Вопрос №{} про щиток", "вопрос  №{} ПРО щиток")).format(q)}]
+            for q in picks]
+
+def pct(lat, p): return lat[min(len(lat) - 1, int(len(lat) * p))] * 1000
+
+async def run(histories, interval, ask):
+    lat, failed = [], 0
+    async def one(i, h):
+        nonlocal failed
+        await asyncio.sleep(i * interval)
+        t = time.perf_counter()
+        try: await ask(h)
+        except asyncio.TimeoutError: failed += 1; return   # очередь к хосту длиннее таймаута
+        lat.append(time.perf_counter() - t)
+    t0 = time.perf_counter()
+    await asyncio.gather(*[one(i, h) for i, h in enumerate(histories)])
+    if failed: print(f"  таймаутов: {failed}")
+    return time.perf_counter() - t0, sorted(lat)
+
+async def main():
+    n = int(sys.argv[1]) if len(sys.argv) > 1 else 1000
+    distinct = int(sys.argv[2]) if len(sys.argv) > 2 else 300
+    interval = (float(sys.argv[3]) if len(sys.argv) > 3 else 20) / 1000
+    delay = float(sys.argv[4]) if len(sys.argv) > 4 else 0.1
+    stub = Stub(chat_delay=delay); await stub.start(PORT)
+    histories = workload(n, distinct)
+    print(f"{n} вопросов, {distinct} разных, каждые {interval * 1000:.0f} мс; ответ заглушки {delay * 1000:.0f} мс;"
+          f" соединений на хост {bot.HTTP_PER_HOST_LIMIT}")
+    try:
+        async def direct(h): return await bot._llm_fetch(bot._llm_key(h), h)
+        bot.LLM_CACHE.max_items = 0
+        wall, lat = await run(histories, interval, direct)
+        print(f"без кэша:  наверх {stub.requests:5}, p50 {pct(lat, .5):6.1f} мс, p95 {pct(lat, .95):6.1f} мс, всего {wall:.2f} с")
+
+        bot.LLM_CACHE.max_items = bot.LLM_CACHE_MAX; bot.LLM_CACHE.clear()
+        c = bot.LLM_CACHE; c.hits = c.misses = 0; bot.llm_coalesced = 0; before = stub.requests
+        wall, lat = await run(histories, interval, bot.llm_reply)
+        up = stub.requests - before
+        print(f"с кэшем:   наверх {up:5}, p50 {pct(lat, .5):6.1f} мс, p95 {pct(lat, .95):6.1f} мс, всего {wall:.2f} с")
+        print(f"попаданий в кэш {c.hits} ({100 * c.hits / n:.0f}%), склеено одновременных {bot.llm_coalesced},"
+              f" сэкономлено запросов {100 * (1 - up / n):.0f}%")
+    finally:
+        await bot.close_http_session(); await stub.stop()
+
+if __name__ == "__main__":
+    asyncio.run(main())
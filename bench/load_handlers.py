@@ -0,0 +1,47 @@
+# Нагрузочный тест обработчиков против локальной заглушки (bench/stub_upstream.py):
+# N пользователей одновременно пишут свободный текст (запрос в OpenRouter), M — /img
+# (перевод промпта + Hugging Face). Если обработчики не блокируют друг друга, общее
+# время ≈ самый долгий одиночный запрос, а не сумма задержек. Потолок параллелизма
+# задают HTTP_PER_HOST_LIMIT и HTTP_POOL_SIZE — их можно поднять через окружение.
+# python bench/load_handlers.py [текст] [img] [задержка чата, с] [задержка картинки, с]
+import os, sys, asyncio, time
+
+PORT = 8766
+os.environ["OR_CHAT_URL"] = f"http://127.0.0.1:{PORT}/v1/chat/completions"
+os.environ["HF_API_URL"] = f"http://localhost:{PORT}/models"   # другой хост — свой лимит соединений, как у настоящего HF
+from _common import bot          # noqa: E402
+from stub_upstream import Stub   # noqa: E402
+
+class FakeMessage:
+    # то, что обработчики берут у pyrogram.Message; ответы только фиксируются
+    def __init__(self, uid, text):
+        self.from_user = type("U", (), {"id": uid, "username": f"user{uid}"})()
+        self.chat = type("C", (), {"id": uid})()
+        self.text = text; self.command = text.lstrip("/").split()
+        self.answered = None
+
+    async def reply_text(self, text, **kw): self.answered = time.perf_counter()
+    async def reply_photo(self, photo, **kw): self.answered = time.perf_counter()
+
+async def run(n_text, n_img, chat_delay, image_delay):
+    stub = Stub(chat_delay, image_delay); await stub.start(PORT)
+    bot.LLM_CACHE.max_items = 0   # каждый вопрос — отдельный запрос наверх
+    msgs = [FakeMessage(1000 + i, f"подскажите по заказу номер {i}") for i in range(n_text)]
+    imgs = [FakeMessage(5000 + i, f"/img щиток на стене {i}") for i in range(n_img)]
+    t0 = time.perf_counter()
+    await asyncio.gather(*[bot.text_handler(None, m) for m in msgs],
+                         *[bot.image_handler(None, m) for m in imgs])
+    wall = time.perf_counter() - t0
+    lat = sorted(m.answered - t0 for m in msgs + imgs if m.answered)
+    serial = n_text * chat_delay + n_img * (chat_delay + image_delay)
+    print(f"пользователей: {n_text} текст + {n_img} /img; задержка заглушки {chat_delay} с / {image_delay} с")
+    print(f"ответили: {len(lat)} из {n_text + n_img}; запросов наверх {stub.requests}, пик одновременных {stub.peak}"
+          f" (лимит на хост HTTP_PER_HOST_LIMIT={bot.HTTP_PER_HOST_LIMIT})")
+    print(f"общее время {wall:.2f} с (последовательно было бы ≈{serial:.0f} с)")
+    print(f"задержка ответа: медиана {lat[len(lat) // 2]:.2f} с, максимум {lat[-1]:.2f} с")
+    await bot.close_http_session(); await stub.stop()
+
+if __name__ == "__main__":
+    a = [float(x) for x in sys.argv[1:]]
+    asyncio.run(run(int(a[0]) if a else 40, int(a[1]) if len(a) > 1 else 10,
+                    a[2] if len(a) > 2 else 1.0, a[3] if len(a) > 3 else 3.0))
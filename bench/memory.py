@@ -0,0 +1,32 @@
+# Память каталога: список dict (как отдают парсеры) против колоночного ProductStore.
+# Считается через tracemalloc — всё, что выделено под товары, включая attrs и строки.
+# python bench/memory.py [число товаров]
+import gc, sys, tracemalloc
+from _common import bot, make_catalog, best_ms
+
+def measured(build):
+    gc.collect(); tracemalloc.start()
+    obj = build(); gc.collect()
+    size = tracemalloc.get_traced_memory()[0]; tracemalloc.stop()
+    return obj, size
+
+def main():
+    n = int(sys.argv[1]) if len(sys.argv) > 1 else 100000
+    items, dicts = measured(lambda: make_catalog(n))
+    # store собирается из тех же dict, а меряется уже без них
+    def _store():
+        s = bot.ProductStore(make_catalog(n)); gc.collect(); return s
+    store, compact = measured(_store)
+    mb = 1 / 1048576
+    print(f"товаров: {n}")
+    print(f"list[dict]    {dicts * mb:7.1f} МБ  ({dicts / n:,.0f} Б/товар)")
+    print(f"ProductStore  {compact * mb:7.1f} МБ  ({compact / n:,.0f} Б/товар), ×{dicts / compact:.1f} меньше")
+    assert dict(store[n // 2]) == items[n // 2]
+    # цена доступа: карточка товара по сотне строк
+    rows = range(0, n, max(1, n // 100))
+    t_d = best_ms(lambda: [bot._product_caption(items[i]) for i in rows])
+    t_s = best_ms(lambda: [bot._product_caption(store[i]) for i in rows])
+    print(f"100 карточек: dict {t_d:.2f} мс, ProductRow {t_s:.2f} мс")
+
+if __name__ == "__main__":
+    main()
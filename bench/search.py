@@ -0,0 +1,78 @@
+# Поиск: прежний полный проход по каталогу против триграммного индекса снапшота.
+# python bench/search.py [число товаров, по умолчанию 100000]
+import re, sys
+from _common import bot, make_catalog, best_ms
+
+# ── прежняя реализация (до индекса), без изменений по смыслу ──
+INTENT = re.compile(
+    r"(?P<what>кабель|провод|автомат|выключател[ьяь]|пускател[ьяи])?"
+    r".*?(?P<num>\d{1,3})\s*(?P<unit>мм2|мм²|мм|sqmm|а|a)?",
+    re.IGNORECASE
+)
+def old_parse_intent(text):
+    t = (text or "").lower(); brand = None
+    for b in ("abb","schneider","iek","legrand","hager","siemens","rexant","sevkabel"):
+        if b in t: brand = b; break
+    itype = sqmm = amp = None; m = INTENT.search(t)
+    if m:
+        what = (m.group("what") or ""); unit = (m.group("unit") or "").lower()
+        n = int(m.group("num")) if m.group("num") else None
+        if what.startswith("кабель") or "провод" in what: itype = "кабель"
+        elif what.startswith("автомат") or "выключател" in what: itype = "автомат"
+        elif "пускател" in what: itype = "пускатель"
+        if n is not None:
+            if unit in ("мм2","мм²","мм","sqmm"): sqmm = n; itype = itype or "кабель"
+            elif unit in ("а","a"): amp = n; itype = itype or "автомат"
+    return {"type": itype, "sqmm": sqmm, "amp": amp, "brand": brand}
+
+def old_search(catalog, q, limit=10):
+    q = (q or "").strip().lower(); res = []
+    for it in catalog:
+        hay = f"{str(it.get('name','')).lower()} {str(it.get('sku','')).lower()} {str(it.get('brand','')).lower()}"
+        if q in hay:
+            res.append(it)
+            if len(res) >= limit: break
+    return res
+
+def old_search_smart(catalog, qtext, limit=10):
+    intent = old_parse_intent(qtext); q = (qtext or "").strip().lower(); scored = []
+    for p in catalog:
+        name = str(p.get("name","")).lower(); sku = str(p.get("sku","")).lower()
+        brand = str(p.get("brand","")).lower(); ptype = str(p.get("type","")).lower()
+        amp = p.get("amp"); sq = p.get("sqmm"); score = 0
+        if intent["type"]:
+            if intent["type"] not in ptype: continue
+            score += 2
+        if intent["amp"] and isinstance(amp,(int,float)):
+            score += 3 if amp == intent["amp"] else (2 if abs(amp-intent["amp"]) <= 10 else 0)
+        if intent["sqmm"] and isinstance(sq,(int,float)):
+            score += 3 if sq == intent["sqmm"] else (2 if abs(sq-intent["sqmm"]) <= 5 else 0)
+        if intent["brand"] and intent["brand"] in brand: score += 2
+        if q and q in f"{name} {sku} {brand} {ptype}": score += 1
+        if score > 0: scored.append((score, p))
+    if not scored: return old_search(catalog, qtext, limit=limit)
+    scored.sort(key=lambda x: x[0], reverse=True)
+    return [p for _, p in scored[:limit]]
+
+QUERIES = [
+    "автомат 16А abb", "кабель 2.5 мм2", "пускатель 25А катушка 220В", "IEK-000123",
+    "ВВГнг-LS 3х6", "schneider", "выключатель C32", "что-то, чего нет в каталоге",
+]
+
+def main():
+    n = int(sys.argv[1]) if len(sys.argv) > 1 else 100000
+    items = make_catalog(n)
+    snap = bot.CatalogSnapshot(items=items, index=bot.build_index(items))
+    print(f"каталог: {n} товаров")
+    print(f"{'запрос':34} {'скан, мс':>10} {'индекс, мс':>11} {'найдено':>8}")
+    tot_old = tot_new = 0.0
+    for q in QUERIES:
+        t_old = best_ms(lambda: old_search_smart(items, q, 8), repeat=3)
+        t_new = best_ms(lambda: (bot._intent_cache.clear(), bot.search_products_smart(q, limit=8, snap=snap)), repeat=3)
+        found = len(bot.search_products_smart(q, limit=8, snap=snap))
+        tot_old += t_old; tot_new += t_new
+        print(f"{q[:34]:34} {t_old:10.1f} {t_new:11.2f} {found:8}")
+    print(f"{'итого':34} {tot_old:10.1f} {tot_new:11.2f}   ×{tot_old / max(tot_new, 1e-9):.0f}")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,59 @@
+# Локальная заглушка OpenRouter и Hugging Face для нагрузочных замеров без сети.
+# Отвечает с заданной задержкой и считает запросы и пик одновременных запросов.
+#   python bench/stub_upstream.py --port 8765 --chat-delay 1 --image-delay 3
+# Бот направляется на неё переменными окружения:
+#   OR_CHAT_URL=http://127.0.0.1:8765/v1/chat/completions HF_API_URL=http://127.0.0.1:8765/models
+import argparse, asyncio, base64
+from aiohttp import web
+
+# PNG 1×1 — Content-Type image/png, как у настоящей модели
+PNG = base64.b64decode("iVBORw0KGgoAAAANSUhEUgAAAAEAAAABCAYAAAAfFcSJAAAADUlEQVR42mP8z8BQDwAEhQGAhKmMIQAAAABJRU5ErkJggg==")
+
+class Stub:
+    def __init__(self, chat_delay=1.0, image_delay=3.0):
+        self.chat_delay = chat_delay; self.image_delay = image_delay
+        self.requests = 0; self.inflight = 0; self.peak = 0
+        self._runner = None
+
+    async def _track(self, delay):
+        self.requests += 1; self.inflight += 1; self.peak = max(self.peak, self.inflight)
+        try: await asyncio.sleep(delay)
+        finally: self.inflight -= 1
+
+    async def chat(self, req):
+        body = await req.json()
+        await self._track(self.chat_delay)
+        last = body["messages"][-1]["content"]
+        return web.json_response({"choices": [{"message": {"role": "assistant", "content": f"Ответ заглушки на: {last}"}}]})
+
+    async def image(self, req):
+        await req.read()
+        await self._track(self.image_delay)
+        return web.Response(body=PNG, content_type="image/png")
+
+    def app(self) -> web.Application:
+        app = web.Application()
+        app.router.add_post("/v1/chat/completions", self.chat)
+        app.router.add_post("/models/{model:.+}", self.image)
+        return app
+
+    async def start(self, port=8765, host="127.0.0.1"):
+        self._runner = web.AppRunner(self.app(), access_log=None)
+        await self._runner.setup()
+        await web.TCPSite(self._runner, host, port).start()
+        return f"http://{host}:{port}"
+
+    async def stop(self):
+        if self._runner: await self._runner.cleanup()
+
+def main():
+    ap = argparse.ArgumentParser()
+    ap.add_argument("--port", type=int, default=8765)
+    ap.add_argument("--chat-delay", type=float, default=1.0)
+    ap.add_argument("--image-delay", type=float, default=3.0)
+    a = ap.parse_args()
+    stub = Stub(a.chat_delay, a.image_delay)
+    web.run_app(stub.app(), host="127.0.0.1", port=a.port, access_log=None)
+
+if __name__ == "__main__":
+    main()
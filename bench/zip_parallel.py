@@ -0,0 +1,42 @@
+# ZIP-пакет обмена из нескольких import/offers: последовательный разбор против пула процессов.
+# Соседние файлы пересекаются по Ид — проверяется, что более поздний файл перекрывает
+# ранний так же, как при последовательном чтении, и порядок товаров совпадает.
+# python bench/zip_parallel.py [файлов каждого вида] [товаров в файле] [воркеров]
+import io, os, sys, tempfile, time, zipfile
+from _common import bot, cml_groups, cml_import_xml, cml_offers_xml
+
+def build_zip(path, parts, per_part):
+    overlap = per_part // 10
+    with zipfile.ZipFile(path, "w", zipfile.ZIP_DEFLATED) as z:
+        for k in range(parts):
+            goods = range(k * per_part, (k + 1) * per_part + overlap)
+            with z.open(f"import{k}.xml", "w") as raw, io.TextIOWrapper(raw, encoding="utf-8") as f:
+                cml_import_xml(f, goods, cml_groups() if k == 0 else None)
+            with z.open(f"offers{k}.xml", "w") as raw, io.TextIOWrapper(raw, encoding="utf-8") as f:
+                cml_offers_xml(f, goods)
+
+def timed(workers, path):
+    bot.PARSE_WORKERS = workers
+    t = time.perf_counter(); res = bot.read_commerceml(path)
+    return time.perf_counter() - t, res
+
+def main():
+    parts = int(sys.argv[1]) if len(sys.argv) > 1 else 8
+    per_part = int(sys.argv[2]) if len(sys.argv) > 2 else 12500
+    workers = int(sys.argv[3]) if len(sys.argv) > 3 else max(2, os.cpu_count() or 1)
+    path = os.path.join(tempfile.mkdtemp(), "exchange.zip")
+    build_zip(path, parts, per_part)
+    print(f"{2 * parts} файлов, по {per_part} товаров, {os.path.getsize(path) / 1e6:.1f} МБ сжато; ядер: {os.cpu_count()}")
+    try:
+        t_seq, seq = timed(0, path)
+        timed(workers, path)                     # прогрев: spawn воркеров и импорт bot в них
+        t_par, par = timed(workers, path)
+    finally:
+        bot.close_process_pool()
+    assert seq == par and [list(m) for m in seq] == [list(m) for m in par], "результаты расходятся"
+    print(f"товаров {len(seq[0])}, предложений {len(seq[1])} — результаты совпадают, включая порядок")
+    print(f"последовательно:    {t_seq:6.2f} с")
+    print(f"воркеров: {workers}        {t_par:6.2f} с  (x{t_seq / t_par:.2f})")
+
+if __name__ == "__main__":
+    main()
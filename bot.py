@@ -2,18 +2,33 @@
 from pyrogram import Client, filters, idle
 from pyrogram.types import (
     InlineKeyboardMarkup, InlineKeyboardButton,
-    InlineQueryResultPhoto, InlineQueryResultArticle, InputTextMessageContent,
+    InlineQueryResultPhoto, InlineQueryResultCachedPhoto, InlineQueryResultArticle,
+    InputTextMessageContent, InputMediaPhoto,
     ReplyKeyboardMarkup, KeyboardButton
 )
 from pyrogram.enums import ParseMode
+from pyrogram.errors import FloodWait
 from dotenv import load_dotenv
-import os, sys, re, requests, traceback, logging, signal, threading, io, csv, zipfile, json
+import os, sys, re, requests, traceback, logging, signal, threading, csv, zipfile, json, hashlib, time, pickle
+import shutil, tempfile, zlib, base64, secrets
+import asyncio, aiohttp
 import xml.etree.ElementTree as ET
-from collections import defaultdict, Counter, OrderedDict
+from collections import Counter, OrderedDict
+from collections.abc import Mapping
+from array import array
+from bisect import bisect_left, bisect_right
+import heapq, html
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from itertools import count
 from io import BytesIO
+from typing import NamedTuple
+from contextlib import contextmanager
 from datetime import datetime, timedelta, timezone
 from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
 from urllib.parse import urlparse, parse_qs
+from requests.adapters import HTTPAdapter
+from urllib3.exceptions import HTTPError as Urllib3Error
 
 # ─────────────────────────────────────────────────────────────────────────────
 logging.basicConfig(level=logging.INFO, format="%(levelname)s:%(name)s:%(message)s")
@@ -30,11 +45,15 @@ HF_TOKEN = os.getenv("HF_TOKEN")
 # опциональные / дефолты
 OR_MODEL = os.getenv("OR_TEXT_MODEL", "openai/gpt-oss-120b")
 HF_IMAGE_MODEL = os.getenv("HF_IMAGE_MODEL", "stabilityai/sdxl-turbo")
+HF_API_URL = os.getenv("HF_API_URL", "https://api-inference.huggingface.co/models")
 
 CATALOG_URL = os.getenv("CATALOG_URL")
 CATALOG_AUTH_USER = os.getenv("CATALOG_AUTH_USER")
 CATALOG_AUTH_PASS = os.getenv("CATALOG_AUTH_PASS")
 CATALOG_REFRESH_MIN = int(os.getenv("CATALOG_REFRESH_MIN", "30"))
+# выгрузка качается на диск кусками; после обрыва — докачка Range с места обрыва
+CATALOG_CHUNK = 1 << 16
+CATALOG_RESUME_TRIES = int(os.getenv("CATALOG_RESUME_TRIES", "3"))
 
 TELEGRAM_ADMIN_ID = int(os.getenv("TELEGRAM_ADMIN_ID", "0"))
 MANAGER_CHAT_ID = int(os.getenv("MANAGER_CHAT_ID", "0"))
@@ -42,9 +61,51 @@ MANAGER_CHAT_ID = int(os.getenv("MANAGER_CHAT_ID", "0"))
 AUTOSYNC_NOTIFY = os.getenv("AUTOSYNC_NOTIFY", "1") == "1"
 AUTOSYNC_REMIND_EVERY_MIN = int(os.getenv("AUTOSYNC_REMIND_EVERY_MIN", "120"))
 
+HTTP_POOL_SIZE = int(os.getenv("HTTP_POOL_SIZE", "32"))        # всего исходящих соединений
+HTTP_PER_HOST_LIMIT = int(os.getenv("HTTP_PER_HOST_LIMIT", "8"))  # на OpenRouter / Hugging Face каждый
+
 SECRET_EXPORT_TOKEN = os.getenv("SECRET_EXPORT_TOKEN")
 HTTP_PORT = int(os.getenv("PORT", "8080"))
 
+# лимиты Bot API: ~30 сообщений/с на бота, ~1/с в личку, ~20/мин в группу
+SEND_GLOBAL_RATE = float(os.getenv("SEND_GLOBAL_RATE", "25"))
+SEND_CHAT_RATE = float(os.getenv("SEND_CHAT_RATE", "1"))
+SEND_CHAT_BURST = int(os.getenv("SEND_CHAT_BURST", "3"))
+SEND_GROUP_RATE = float(os.getenv("SEND_GROUP_RATE", "0.33"))
+
+# сессии пользователей: сколько держать и как долго без обращений
+SESSION_MAX = int(os.getenv("SESSION_MAX", "10000"))
+SESSION_TTL_MIN = int(os.getenv("SESSION_TTL_MIN", "720"))
+HISTORY_MAX_MB = float(os.getenv("HISTORY_MAX_MB", "32"))
+RESERVE_TTL_MIN = int(os.getenv("RESERVE_TTL_MIN", "60"))
+
+# разбор ZIP-пакетов 1С по файлам и классификация больших выгрузок в пуле процессов:
+# по умолчанию по числу ядер, 0/1 — всё в основном процессе. Пул живёт только
+# на время обновления каталога
+PARSE_WORKERS = int(os.getenv("PARSE_WORKERS", str(os.cpu_count() or 0)))
+CLASSIFY_POOL_MIN = 20000   # меньше товаров — пул не окупает пересылку
+
+# колоночное хранение товаров: меньше памяти, чуть медленнее доступ к полям
+CATALOG_COMPACT = os.getenv("CATALOG_COMPACT", "0") == "1"
+
+# состояние между перезапусками: сессия Pyrogram, снапшот каталога, сессии мастера/броней
+STATE_DIR = os.getenv("STATE_DIR", "state")
+CATALOG_STATE_PATH = os.path.join(STATE_DIR, "catalog.pickle")
+SESSIONS_STATE_PATH = os.path.join(STATE_DIR, "sessions.pickle")
+
+# ответы LLM на одинаковые вопросы: сколько и как долго держать
+LLM_CACHE_MAX = int(os.getenv("LLM_CACHE_MAX", "2000"))
+LLM_CACHE_TTL_MIN = int(os.getenv("LLM_CACHE_TTL_MIN", "60"))
+
+# брони: журнал на диске, доставка менеджеру пачками с повторами
+RESERVE_JOURNAL_PATH = os.path.join(STATE_DIR, "reservations.jsonl")
+RESERVE_BATCH_MAX = 10          # броней в одном сообщении менеджеру
+RESERVE_BATCH_SEC = 2.0         # сколько подождать, чтобы всплеск ушёл одним сообщением
+RESERVE_RETRY_MAX_SEC = 300     # потолок паузы между повторами
+
+PHOTO_CACHE_PATH = os.getenv("PHOTO_CACHE_PATH", os.path.join(STATE_DIR, "photo_file_ids.json"))
+PHOTO_CACHE_FLUSH_SEC = int(os.getenv("PHOTO_CACHE_FLUSH_SEC", "30"))
+
 missing = [k for k, v in {
     "BOT_TOKEN": BOT_TOKEN, "API_ID": API_ID_STR, "API_HASH": API_HASH,
     "OPENROUTER_API_KEY": OPENROUTER_API_KEY, "HF_TOKEN": HF_TOKEN
@@ -57,6 +118,45 @@ except Exception:
     log.error("❌ API_ID должен быть числом, получено: %r", API_ID_STR); sys.exit(1)
 
 # ───────────── Утилиты ─────────────
+OR_CHAT_URL = os.getenv("OR_CHAT_URL", "https://openrouter.ai/api/v1/chat/completions")
+
+_http = None
+def http_session() -> aiohttp.ClientSession:
+    # общий пул соединений; лимит на хост не даёт медленным /img занять все сокеты
+    global _http
+    if _http is None or _http.closed:
+        _http = aiohttp.ClientSession(connector=aiohttp.TCPConnector(
+            limit=HTTP_POOL_SIZE, limit_per_host=HTTP_PER_HOST_LIMIT))
+    return _http
+
+_catalog_http = None
+def catalog_http() -> requests.Session:
+    # синхронный пул для каталога: HEAD, GET и докачка идут по одному keep-alive соединению
+    global _catalog_http
+    if _catalog_http is None:
+        _catalog_http = requests.Session()
+        _catalog_http.mount("https://", HTTPAdapter(pool_connections=1, pool_maxsize=2))
+        _catalog_http.mount("http://", HTTPAdapter(pool_connections=1, pool_maxsize=2))
+        _catalog_http.headers["Accept-Encoding"] = "gzip, deflate"
+    return _catalog_http
+
+async def close_http_session():
+    if _http is not None and not _http.closed:
+        await _http.close()
+
+_pool = None
+def process_pool() -> ProcessPoolExecutor:
+    # spawn, а не fork: в процессе бота уже крутятся потоки Pyrogram и HTTP-хука
+    global _pool
+    if _pool is None:
+        _pool = ProcessPoolExecutor(max_workers=PARSE_WORKERS, mp_context=multiprocessing.get_context("spawn"))
+    return _pool
+
+def close_process_pool():
+    # воркеры — полные копии интерпретатора с bot.py: между обновлениями их не держим
+    global _pool
+    if _pool is not None: _pool.shutdown(wait=False, cancel_futures=True); _pool = None
+
 def or_headers(title: str = "TelegramBot"):
     return {
         "Authorization": f"Bearer {OPENROUTER_API_KEY}",
@@ -69,18 +169,17 @@ def or_headers(title: str = "TelegramBot"):
 def has_cyrillic(text: str) -> bool:
     return bool(re.search(r"[\u0400-\u04FF]", text or ""))
 
-def translate_to_english(text: str) -> str:
+async def translate_to_english(text: str) -> str:
     try:
         payload = {"model": OR_MODEL, "messages": [
             {"role": "system", "content": "Translate Russian to concise English. Return ONLY translated text."},
             {"role": "user", "content": text}
         ], "temperature": 0.2}
-        r = requests.post("https://openrouter.ai/api/v1/chat/completions",
-                          headers=or_headers("PromptTranslator"), json=payload,
-                          timeout=40, allow_redirects=False)
-        if r.status_code == 200 and r.headers.get("content-type","").startswith("application/json"):
-            return r.json()["choices"][0]["message"]["content"].strip()
-        log.warning("Translate HTTP %s | %s", r.status_code, r.text[:300])
+        async with http_session().post(OR_CHAT_URL, headers=or_headers("PromptTranslator"), json=payload,
+                                       timeout=aiohttp.ClientTimeout(total=40), allow_redirects=False) as r:
+            if r.status == 200 and r.headers.get("content-type","").startswith("application/json"):
+                return (await r.json())["choices"][0]["message"]["content"].strip()
+            log.warning("Translate HTTP %s | %s", r.status, (await r.text())[:300])
     except Exception:
         traceback.print_exc()
     return text
@@ -100,47 +199,435 @@ def unslugify(slug: str, choices=None, fallback="Без категории") ->
     if choices:
         for c in choices:
             if slugify(c) == slug: return c
-    for c in catalog_index.get("categories", []):
-        if slugify(c) == slug: return c
-    return fallback
+    cat = _snapshot.index.get("cat_by_slug", {}).get(slug)
+    if cat is not None: return cat
+    # слаг старого формата (кнопки и сессии мастера до cb_slug): кириллица в нём
+    # схлопывается в «_», поэтому при совпадении побеждает первая категория
+    by_slug = rendered(("slugs",), lambda: {slugify(c): c for c in reversed(_snapshot.index.get("categories", []))})
+    return by_slug.get(slug, fallback)
+
+# ───────────── callback_data ─────────────
+# "<схема><op>:<арг>:<арг>…", схема — цифра CB_SCHEME. Кнопки уже отправленных
+# сообщений в старом формате («reserve:…», «fw2v:…») идут в те же обработчики.
+# Категории и товары передаются короткими хеш-слагами, обратные словари — в индексе.
+CB_SCHEME = "1"
+_CALLBACKS = {}   # op -> (обработчик, преобразователи аргументов или None — как есть)
+
+def cb(op, *args) -> str:
+    data = ":".join((CB_SCHEME + op, *map(str, args)))
+    if len(data.encode()) > 64: raise ValueError(f"callback_data длиннее 64 байт: {data!r}")
+    return data
+
+def cb_slug(s) -> str:
+    # 72 бита blake2b в base64url — 12 символов, стабилен между выгрузками
+    return base64.urlsafe_b64encode(hashlib.blake2b(str(s).encode(), digest_size=9).digest()).decode()
+
+def on_callback(op, *convs, legacy=None):
+    # convs — по одному на аргумент; число аргументов и их разбор проверяет диспетчер
+    def deco(fn):
+        _CALLBACKS[CB_SCHEME + op] = (fn, convs)
+        if legacy: _CALLBACKS[legacy] = (fn, convs)
+        return fn
+    return deco
+
+# ───────────── Очередь отправки ─────────────
+# Все исходящие вызовы Bot API идут через Outbox: token bucket на бота и на
+# каждый чат, FloodWait усыпляет только свой чат, ответы пользователю
+# обгоняют карточки и уведомления.
+PRIO_REPLY, PRIO_NOTIFY, PRIO_BULK = 0, 1, 2
+
+class _Bucket:
+    __slots__ = ("rate", "cap", "tokens", "ts")
+    def __init__(self, rate, cap):
+        self.rate = rate; self.cap = cap; self.tokens = float(cap); self.ts = time.monotonic()
+    def wait(self, now) -> float:
+        self.tokens = min(self.cap, self.tokens + (now - self.ts) * self.rate); self.ts = now
+        return 0.0 if self.tokens >= 1 else (1 - self.tokens) / self.rate
+    def take(self):
+        self.tokens -= 1
+
+class Outbox:
+    CHATS_MAX = 10000   # сколько бакетов чатов держать
+
+    def __init__(self):
+        self._global = _Bucket(SEND_GLOBAL_RATE, max(1, int(SEND_GLOBAL_RATE)))
+        self._chats = OrderedDict()   # chat_id -> _Bucket
+        self._blocked = {}            # chat_id -> monotonic(), до которого чат спит после FloodWait
+        self._pending = {}            # chat_id -> heap[(prio, seq, job)]
+        self._inflight = set()        # в чате не больше одного вызова разом — порядок сообщений сохраняется
+        self._seq = count()
+        self._wake = None; self._task = None
+        self._running = set()         # ссылки на задачи вызовов, чтобы их не собрал GC
+
+    def _bucket(self, cid):
+        b = self._chats.get(cid)
+        if b is not None:
+            self._chats.move_to_end(cid); return b
+        b = self._chats[cid] = (_Bucket(SEND_CHAT_RATE, SEND_CHAT_BURST) if cid > 0
+                                else _Bucket(SEND_GROUP_RATE, 1))
+        if len(self._chats) > self.CHATS_MAX:
+            old = next(iter(self._chats))
+            if old not in self._pending:
+                del self._chats[old]; self._blocked.pop(old, None)
+        return b
+
+    def _ready_in(self, cid, now) -> float:
+        if cid in self._inflight: return float("inf")
+        until = self._blocked.get(cid)
+        if until is not None and until <= now: del self._blocked[cid]; until = None
+        return max((until or now) - now, self._bucket(cid).wait(now))
+
+    async def call(self, chat_id, fn, *args, prio=PRIO_REPLY, **kw):
+        if self._task is None or self._task.done():
+            self._wake = asyncio.Event()
+            self._task = asyncio.get_running_loop().create_task(self._run())
+        fut = asyncio.get_running_loop().create_future()
+        self._push(chat_id, (prio, next(self._seq), (fn, args, kw, fut)))
+        return await fut
+
+    def _push(self, cid, entry):
+        heapq.heappush(self._pending.setdefault(cid, []), entry)
+        self._wake.set()
+
+    async def _run(self):
+        while True:
+            now = time.monotonic(); best = None; best_cid = None; sleep = None
+            for cid, q in self._pending.items():
+                t = self._ready_in(cid, now)
+                if t <= 0:
+                    if best is None or q[0][:2] < best: best = q[0][:2]; best_cid = cid
+                else:
+                    if t != float("inf"): sleep = t if sleep is None else min(sleep, t)
+            if best is None:
+                self._wake.clear()
+                try: await asyncio.wait_for(self._wake.wait(), sleep)
+                except asyncio.TimeoutError: pass
+                continue
+            g = self._global.wait(now)
+            if g > 0:
+                await asyncio.sleep(g); continue
+            q = self._pending[best_cid]; entry = heapq.heappop(q)
+            if not q: del self._pending[best_cid]
+            self._global.take(); self._bucket(best_cid).take(); self._inflight.add(best_cid)
+            # сам вызов — отдельной задачей: очередь не ждёт RTT до Telegram
+            t = asyncio.get_running_loop().create_task(self._exec(best_cid, entry))
+            self._running.add(t); t.add_done_callback(self._running.discard)
+
+    async def _exec(self, cid, entry):
+        fn, args, kw, fut = entry[2]
+        try:
+            if fut.done(): return
+            res = await fn(*args, **kw)
+            if not fut.done(): fut.set_result(res)
+        except FloodWait as e:
+            wait = float(getattr(e, "value", 1) or 1)
+            log.warning("FloodWait %ss в чате %s — чат на паузе", wait, cid)
+            self._blocked[cid] = time.monotonic() + wait
+            heapq.heappush(self._pending.setdefault(cid, []), entry)
+        except Exception as e:
+            if not fut.done(): fut.set_exception(e)
+        finally:
+            self._inflight.discard(cid); self._wake.set()
+
+outbox = Outbox()
+
+async def tg(method, *args, prio=PRIO_REPLY, **kw):
+    # tg(message.reply_text, "...") — вызов метода Message через очередь его чата
+    return await outbox.call(method.__self__.chat.id, method, *args, prio=prio, **kw)
+
+def notify(chat_id, text, prio=PRIO_NOTIFY):
+    # из фоновых потоков (таймер, HTTP-хук, обновление каталога): не ждём отправки
+    if not chat_id or not getattr(app, "is_connected", False): return
+    def _done(f):
+        if not f.cancelled() and f.exception(): log.error("Не отправлено в %s: %s", chat_id, f.exception())
+    asyncio.run_coroutine_threadsafe(
+        outbox.call(chat_id, app.send_message, chat_id, text, prio=prio), app.loop).add_done_callback(_done)
+
+# ───────────── Журнал броней ─────────────
+# Бронь сначала дописывается в журнал (строка JSON на запись), ответ пользователю
+# не ждёт Telegram. Фоновая задача шлёт менеджеру пачки и повторяет при ошибках.
+# {"rid", "ts", "text"} — новая бронь, {"sent": [rid, ...]} — доставлены. На старте
+# недоставленные поднимаются из журнала, а сам он переписывается без доставленных.
+class ReserveJournal:
+    def __init__(self, path):
+        self.path = path
+        self._pending = OrderedDict()   # rid -> запись, в порядке поступления
+        self._f = None; self._lock = threading.Lock()
+        self._wake = None; self._task = None
+        self.sent = self.failures = 0
+
+    def load(self):
+        pending = OrderedDict()
+        try:
+            with open(self.path, encoding="utf-8") as f:
+                for line in f:
+                    try: rec = json.loads(line)
+                    except ValueError: continue   # строка, недописанная при падении
+                    if "rid" in rec: pending[rec["rid"]] = rec
+                    for rid in rec.get("sent", ()): pending.pop(rid, None)
+        except FileNotFoundError:
+            return
+        self._pending = pending
+        os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+        tmp = self.path + ".tmp"
+        with open(tmp, "w", encoding="utf-8") as f:
+            for rec in pending.values(): f.write(json.dumps(rec, ensure_ascii=False) + "\n")
+            f.flush(); os.fsync(f.fileno())
+        os.replace(tmp, self.path)
+        if pending: log.info("Журнал броней: %d не доставлено менеджеру", len(pending))
+
+    def _append(self, rec):
+        with self._lock:
+            if self._f is None:
+                os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+                self._f = open(self.path, "a", encoding="utf-8")
+            self._f.write(json.dumps(rec, ensure_ascii=False) + "\n")
+            self._f.flush(); os.fsync(self._f.fileno())
+
+    async def submit(self, text):
+        rec = {"rid": f"{time.time_ns():x}", "ts": time.time(), "text": text}
+        try: await asyncio.to_thread(self._append, rec)
+        except OSError: traceback.print_exc()   # диск недоступен — доставим хотя бы из памяти
+        self._pending[rec["rid"]] = rec
+        self.kick()
+
+    def kick(self):
+        # вызывать из цикла бота
+        if self._task is None or self._task.done():
+            self._wake = asyncio.Event()
+            self._task = asyncio.get_running_loop().create_task(self._run())
+        self._wake.set()
+
+    def _batch(self) -> list:
+        batch = []; size = 0
+        for rec in self._pending.values():
+            if batch and (len(batch) >= RESERVE_BATCH_MAX or size + len(rec["text"]) > 4000): break
+            batch.append(rec); size += len(rec["text"]) + 2
+        return batch
+
+    async def _run(self):
+        fails = 0
+        while True:
+            if not self._pending:
+                self._wake.clear(); await self._wake.wait(); continue
+            if len(self._pending) < RESERVE_BATCH_MAX:
+                await asyncio.sleep(RESERVE_BATCH_SEC)
+            batch = self._batch()
+            try:
+                await outbox.call(MANAGER_CHAT_ID, app.send_message, MANAGER_CHAT_ID,
+                                  "\n\n".join(r["text"] for r in batch), prio=PRIO_NOTIFY)
+            except Exception as e:
+                fails += 1; self.failures += 1
+                delay = min(RESERVE_RETRY_MAX_SEC, 2 ** fails)
+                log.warning("Брони не доставлены менеджеру (%s), повтор через %d с", e, delay)
+                await asyncio.sleep(delay); continue
+            fails = 0; self.sent += len(batch)
+            rids = [r["rid"] for r in batch]
+            for rid in rids: self._pending.pop(rid, None)
+            try: await asyncio.to_thread(self._append, {"sent": rids})
+            except OSError: traceback.print_exc()   # после рестарта эти брони придут повторно
+
+    def close(self):
+        with self._lock:
+            if self._f is not None: self._f.close(); self._f = None
+
+    def __len__(self): return len(self._pending)
+
+    def stats(self) -> str:
+        return f"Брони менеджеру: в очереди {len(self._pending)}, доставлено {self.sent}, ошибок {self.failures}"
+
+reservations = ReserveJournal(RESERVE_JOURNAL_PATH)
 
 # ───────────── Память ─────────────
-chat_history = defaultdict(list)
+def _approx_size(v, depth=0) -> int:
+    # грубая оценка в байтах — для лимита памяти хватает
+    n = sys.getsizeof(v)
+    if depth < 4:
+        if isinstance(v, dict): n += sum(_approx_size(k, depth+1) + _approx_size(x, depth+1) for k, x in v.items())
+        elif isinstance(v, (list, tuple, set)): n += sum(_approx_size(x, depth+1) for x in v)
+    return n
+
+class SessionStore:
+    """Словарь сессий с вытеснением: LRU по числу записей, TTL с момента
+    последнего обращения и (если задан max_bytes) лимит по оценке памяти."""
+    def __init__(self, name, max_items=SESSION_MAX, ttl=SESSION_TTL_MIN * 60, max_bytes=None, default_factory=None):
+        self.name = name; self.max_items = max_items; self.ttl = ttl
+        self.max_bytes = max_bytes; self.default_factory = default_factory
+        self._data = OrderedDict()   # key -> [expires_at, value, size]; порядок = давность обращения
+        self.bytes = 0
+        self.hits = self.misses = self.evictions = self.expired = 0
+
+    def _drop(self, key):
+        e = self._data.pop(key); self.bytes -= e[2]; return e
+
+    def _sweep(self, now):
+        # TTL продлевается при обращении, поэтому просроченные всегда в начале
+        while self._data:
+            key, e = next(iter(self._data.items()))
+            if e[0] > now: break
+            self._drop(key); self.expired += 1
+        while self._data and (len(self._data) > self.max_items or
+                              (self.max_bytes is not None and self.bytes > self.max_bytes)):
+            self._drop(next(iter(self._data))); self.evictions += 1
+
+    def get(self, key, default=None):
+        e = self._data.get(key); now = time.monotonic()
+        if e is None or e[0] <= now:
+            if e is not None: self._drop(key); self.expired += 1
+            self.misses += 1; return default
+        self.hits += 1; e[0] = now + self.ttl; self._data.move_to_end(key)
+        return e[1]
+
+    def __getitem__(self, key):
+        v = self.get(key, _MISSING)
+        if v is _MISSING:
+            if self.default_factory is None: raise KeyError(key)
+            v = self[key] = self.default_factory()
+        return v
+
+    def __setitem__(self, key, value):
+        now = time.monotonic(); size = _approx_size(value) if self.max_bytes is not None else 0
+        if key in self._data: self._drop(key)
+        self._data[key] = [now + self.ttl, value, size]; self.bytes += size
+        self._sweep(now)
+
+    def __contains__(self, key):
+        e = self._data.get(key)
+        return e is not None and e[0] > time.monotonic()
+
+    def __len__(self): return len(self._data)
+
+    def clear(self):
+        self._data.clear(); self.bytes = 0
+
+    def pop(self, key, default=None):
+        e = self._data.get(key)
+        if e is None: return default
+        self._drop(key); return e[1] if e[0] > time.monotonic() else default
+
+    def dump(self) -> list:
+        # [(key, value, сколько секунд осталось жить)] — monotonic() между запусками не переносится
+        now = time.monotonic()
+        return [(k, e[1], e[0] - now) for k, e in self._data.items() if e[0] > now]
+
+    def load(self, entries, elapsed=0.0):
+        for k, v, left in entries:
+            if left - elapsed <= 0: continue
+            self[k] = v; self._data[k][0] = time.monotonic() + left - elapsed
+
+    def stats(self) -> str:
+        total = self.hits + self.misses
+        rate = f"{100 * self.hits / total:.0f}%" if total else "—"
+        mem = f", ~{self.bytes / 1048576:.1f} МБ" if self.max_bytes is not None else ""
+        return (f"{self.name}: {len(self._data)} шт.{mem}, попаданий {self.hits} ({rate}), "
+                f"промахов {self.misses}, вытеснено {self.evictions}, истекло {self.expired}")
+
+_MISSING = object()
+SESSION_STORES = []
+
+def session_store(*a, **kw) -> SessionStore:
+    st = SessionStore(*a, **kw); SESSION_STORES.append(st); return st
+
+chat_history = session_store("История чата", max_bytes=int(HISTORY_MAX_MB * 1048576), default_factory=list)
 HISTORY_LIMIT = 10
 def clamp_history(h): return h[-HISTORY_LIMIT:] if len(h) > HISTORY_LIMIT else h
 
 # ───────────── Каталог / кэш ─────────────
-catalog = []               # каждый товар: {..., attrs: {Название: Значение}}
+class CatalogSnapshot(NamedTuple):
+    # каталог и индексы публикуются одним объектом: читатели берут ссылку
+    # на _snapshot один раз и никогда не видят наполовину собранный индекс
+    items: list                # каждый товар: {..., attrs: {Название: Значение}}
+    index: dict                # см. build_index()
+    version: int = 0
+
 catalog_last_fetch = None
-catalog_lock = threading.Lock()
-pending_reserve = {}       # user_id -> product_id
+catalog_lock = threading.Lock()   # защищает только _refresh_job, не чтение каталога
+_refresh_job = None
+pending_reserve = session_store("Брони", ttl=RESERVE_TTL_MIN * 60)   # user_id -> product_id
 
-# индексы
-catalog_index = {
+# индексы пустого каталога
+_EMPTY_INDEX = {
     "categories": [],
+    "cat_counts": Counter(),  # cat -> число товаров
     "brands_by_cat": {},      # cat -> Counter(brand)
     "attrs_by_cat": {},       # cat -> {attr_name -> Counter(values)}
     "attr_steps_by_cat": {},  # cat -> [attr_name,...]
+    # поисковый индекс (позиции = индексы в items снапшота)
+    "hay": [],                # "name sku brand type" в нижнем регистре
+    "hay_cut": array("I"),    # длина части "name sku brand" в hay
+    "trigrams": {},           # триграмма -> array(позиции)
+    "by_type": {},            # type -> array(позиции)
+    "by_brand": {},           # brand (lower) -> array(позиции)
+    "by_amp": {}, "by_sqmm": {},  # число -> array(позиции)
+    "by_coil": {}, "by_ip": {},   # напряжение катушки / степень IP -> array(позиции)
+    "num_by_type": {},        # "amp"/"sqmm" -> type -> число -> array(позиции)
+    "nearest": {},            # "amp"/"sqmm" -> type -> (array("d") значений по возрастанию, array позиций)
+    "intent_vocab": None,     # build_intent_vocab() по типам и брендам каталога
+    # фасеты мастера: _norm(cat) -> {"all": array, "brand": {brand: array},
+    #   "avail": {"in"/"out"/"unknown": array}, "attrs": {attr: {value: array}}}
+    "facets": {},
+    # для дельта-обновлений
+    "slot_by_id": {},         # id -> позиция
+    "slot_by_sku": {},        # sku -> позиция (при повторах — первый товар)
+    "hash_by_id": {},         # id -> хеш содержимого товара
+    # обратные словари для callback_data (cb_slug)
+    "cat_by_slug": {},        # слаг -> категория
+    "id_by_slug": {},         # слаг -> id товара
 }
+_snapshot = CatalogSnapshot(items=[], index=_EMPTY_INDEX)
 CAT_PAGE = 8
 ITEMS_PAGE = 5
+RESULTS_MAX = int(os.getenv("RESULTS_MAX", "1000"))  # сколько выдач помнить для листания
+INLINE_PAGE = 20                                       # результатов на один ответ inline (макс. 50)
+INLINE_CACHE_TIME = int(os.getenv("INLINE_CACHE_TIME", "30"))
+INLINE_CACHE_MAX = int(os.getenv("INLINE_CACHE_MAX", "512"))
+INLINE_REFILTER_MAX = 5000  # до скольких позиций дешевле отфильтровать выдачу префикса, чем идти в индекс
 VALUES_PER_STEP = 8
+WIZ_CAND_MAX_MB = float(os.getenv("WIZ_CAND_MAX_MB", "16"))   # кэш промежуточных множеств мастера
 
 # автонапоминания
 _catalog_etag = None
 _catalog_last_modified = None
-_catalog_last_items = 0
 _catalog_last_change = None
 _last_reminder_at = None
 
+# ───────────── Кэш отрисовки ─────────────
+# Список категорий, экраны мастера и карточки зависят только от снапшота и
+# состояния экрана: готовые текст/клавиатура живут до смены версии каталога.
+RENDER_CACHE_MAX = int(os.getenv("RENDER_CACHE_MAX", "5000"))
+RENDERED = session_store("Отрисовка", max_items=RENDER_CACHE_MAX)
+_rendered_ver = None
+
+def rendered(key, build, snap=None):
+    # вызывать из потока бота; после обновления каталога кэш сбрасывается целиком
+    global _rendered_ver
+    ver = (snap or _snapshot).version
+    if ver != _rendered_ver:
+        RENDERED.clear(); _rendered_ver = ver
+    v = RENDERED.get(key, _MISSING)
+    if v is _MISSING:
+        v = RENDERED[key] = build()
+    return v
+
 # карточка товара
+def _fmt_price(val):
+    try:
+        return f"{float(val):,.0f}".replace(",", " ")
+    except Exception:
+        return str(val)
+
+def _card(kind, p, build):
+    # ключ — сам объект товара, а не его id: в сохранённых выдачах лежат товары
+    # прошлых версий каталога, их карточки не должны подменять актуальные.
+    # Объект хранится в записи, поэтому его id() не переиспользуется, пока она жива
+    owner, key = (p._s, (id(p._s), p._i)) if isinstance(p, ProductRow) else (p, id(p))
+    return rendered((kind, key), lambda: (owner, build()))[1]
+
 def product_caption(p):
+    return _card("caption", p, lambda: _product_caption(p))
+
+def _product_caption(p):
     price = p.get("price"); stock = p.get("stock")
-    def _fmt_price(val):
-        try:
-            return f"{float(val):,.0f}".replace(",", " ")
-        except Exception:
-            return str(val)
     return "\n".join([
         f"🛒 {p.get('name','')}",
         f"Артикул: {p.get('sku','—')}",
@@ -148,18 +635,151 @@ def product_caption(p):
         f"В наличии: {stock} шт." if stock is not None else "Наличие: уточняйте",
     ])
 
-def product_keyboard(p):
+def product_keyboard(p, inline=False):
+    return _card(("kb", inline), p, lambda: _product_keyboard(p, inline))
+
+def _product_keyboard(p, inline):
+    if inline:
+        # у сообщений «via @bot» нет cq.message — колбэки там не работают
+        return InlineKeyboardMarkup([[InlineKeyboardButton("🔎 Искать ещё", switch_inline_query_current_chat="")]])
     pid = p.get("id") or p.get("sku")
-    btns = [[InlineKeyboardButton("📝 Забронировать", callback_data=f"reserve:{pid}")]]
+    btns = [[InlineKeyboardButton("📝 Забронировать", callback_data=cb("r", cb_slug(pid)))]]
     if p.get("category"):
-        btns.append([InlineKeyboardButton(f"📂 Категория: {p['category']}", callback_data=f"cats:p:1")])
+        btns.append([InlineKeyboardButton(f"📂 Категория: {p['category']}", callback_data=cb("c", 1))])
     btns.append([InlineKeyboardButton("🔎 Искать в чате", switch_inline_query_current_chat=p.get("sku",""))])
     return InlineKeyboardMarkup(btns)
 
-def send_product_message(message, p):
+# ───────────── Кэш file_id фото ─────────────
+# Telegram отдаёт file_id загруженного фото: повторная отправка по нему не
+# скачивает картинку с CDN магазина заново. pid -> [image_url, file_id]
+def _load_photo_cache() -> dict:
+    try:
+        with open(PHOTO_CACHE_PATH, encoding="utf-8") as f:
+            data = json.load(f)
+        return data if isinstance(data, dict) else {}
+    except FileNotFoundError:
+        return {}
+    except Exception:
+        traceback.print_exc(); return {}
+
+photo_file_ids = _load_photo_cache()
+_photo_cache_flush = None   # отложенная запись на диск (asyncio.TimerHandle)
+
+def save_photo_cache():
+    global _photo_cache_flush
+    if _photo_cache_flush is not None: _photo_cache_flush.cancel()
+    _photo_cache_flush = None
+    try:
+        os.makedirs(os.path.dirname(PHOTO_CACHE_PATH) or ".", exist_ok=True)
+        tmp = PHOTO_CACHE_PATH + ".tmp"
+        with open(tmp, "w", encoding="utf-8") as f:
+            json.dump(dict(photo_file_ids), f, ensure_ascii=False)
+        os.replace(tmp, PHOTO_CACHE_PATH)
+    except Exception:
+        traceback.print_exc()
+
+def _remember_photo(pid: str, url: str, file_id: str):
+    global _photo_cache_flush
+    photo_file_ids[pid] = [url, file_id]
+    if _photo_cache_flush is None:
+        _photo_cache_flush = asyncio.get_running_loop().call_later(PHOTO_CACHE_FLUSH_SEC, save_photo_cache)
+
+def prune_photo_cache(snap):
+    # после обновления каталога: товар удалён или у него сменилась картинка
+    items = snap.items; slot_by_id = snap.index.get("slot_by_id") or {}
+    stale = []
+    for pid, (url, _) in list(photo_file_ids.items()):
+        s = slot_by_id.get(pid)
+        if s is None or items[s].get("image_url") != url: stale.append(pid)
+    for pid in stale: photo_file_ids.pop(pid, None)
+    if stale:
+        log.info("Кэш фото: сброшено %d file_id", len(stale)); save_photo_cache()
+
+async def send_product_message(message, p):
     img = p.get("image_url"); caption = product_caption(p); kb = product_keyboard(p)
-    if img: message.reply_photo(img, caption=caption, reply_markup=kb)
-    else:   message.reply_text(caption, reply_markup=kb)
+    if not img:
+        await tg(message.reply_text, caption, reply_markup=kb, prio=PRIO_BULK); return
+    pid = str(p.get("id") or p.get("sku")); cached = photo_file_ids.get(pid)
+    if cached and cached[0] == img:
+        try:
+            await tg(message.reply_photo, cached[1], caption=caption, reply_markup=kb, prio=PRIO_BULK); return
+        except Exception:
+            # file_id мог протухнуть — забываем и шлём по URL
+            traceback.print_exc(); photo_file_ids.pop(pid, None)
+    sent = await tg(message.reply_photo, img, caption=caption, reply_markup=kb, prio=PRIO_BULK)
+    if sent is not None and getattr(sent, "photo", None):
+        _remember_photo(pid, img, sent.photo.file_id)
+
+# ───────────── Выдача результатов страницами ─────────────
+# Вместо 10–20 отдельных карточек — одно сообщение со списком и кнопками
+# «назад/вперёд»: листание редактирует его по сохранённой выдаче,
+# карточка или фото страницы (одной медиагруппой) — по кнопке.
+# Токен случайный и привязан к чату: выдачи не переживают рестарт, и кнопка
+# старого сообщения не должна открыть чужой поиск с тем же номером.
+RESULTS = session_store("Выдачи", max_items=RESULTS_MAX)  # token -> {"chat": id, "title": str, "items": [товары]}
+
+def _results_put(title, items, chat_id) -> str:
+    token = secrets.token_urlsafe(6)
+    RESULTS[token] = {"chat": chat_id, "title": title,
+                      "items": items if isinstance(items, (list, ProductStore)) else list(items)}
+    return token
+
+def _results_get(token, chat_id):
+    res = RESULTS.get(token)
+    return res if res is not None and res["chat"] == chat_id else None
+
+def results_page(token, page, chat_id):
+    res = _results_get(token, chat_id)
+    if res is None: return None, None
+    items = res["items"]
+    pages = max(1, (len(items) + ITEMS_PAGE - 1) // ITEMS_PAGE)
+    page = max(1, min(page, pages))
+    start = (page - 1) * ITEMS_PAGE
+    lines = [res["title"], f"Найдено: {len(items)} шт. · стр. {page}/{pages}", ""]
+    rows = []
+    for n, p in enumerate(items[start:start+ITEMS_PAGE], start + 1):
+        price = p.get("price"); stock = p.get("stock")
+        meta = [f"Арт. {html.escape(str(p.get('sku') or '—'))}",
+                f"{_fmt_price(price)} ₽" if price is not None else "цена по запросу"]
+        if stock is not None: meta.append(f"{stock} шт.")
+        lines.append(f"{n}. <b>{html.escape(p.get('name',''))}</b>\n    " + " · ".join(meta))
+        rows.append([InlineKeyboardButton(f"🛒 {n}. {p.get('name','')[:40]}", callback_data=cb("s", token, "o", n-1))])
+    if any(p.get("image_url") for p in items[start:start+ITEMS_PAGE]):
+        rows.append([InlineKeyboardButton("🖼 Фото страницы", callback_data=cb("s", token, "g", page))])
+    nav = []
+    if page > 1: nav.append(InlineKeyboardButton("« Назад", callback_data=cb("s", token, "p", page-1)))
+    if pages > 1: nav.append(InlineKeyboardButton(f"{page}/{pages}", callback_data=cb("n")))
+    if page < pages: nav.append(InlineKeyboardButton("Вперёд »", callback_data=cb("s", token, "p", page+1)))
+    if nav: rows.append(nav)
+    return "\n".join(lines), InlineKeyboardMarkup(rows)
+
+async def send_results(message, title, items):
+    token = _results_put(title, items, message.chat.id)
+    txt, kb = results_page(token, 1, message.chat.id)
+    await tg(message.reply_text, txt, reply_markup=kb)
+
+async def send_results_photos(message, token, page):
+    # фото страницы одним send_media_group (до 10 шт. за вызов)
+    res = _results_get(token, message.chat.id)
+    if res is None: return False
+    start = (max(1, page) - 1) * ITEMS_PAGE
+    chunk = [p for p in res["items"][start:start+ITEMS_PAGE] if p.get("image_url")][:10]
+    if not chunk: return True
+    media = []
+    for p in chunk:
+        cached = photo_file_ids.get(str(p.get("id") or p.get("sku")))
+        src = cached[1] if cached and cached[0] == p["image_url"] else p["image_url"]
+        media.append(InputMediaPhoto(src, caption=product_caption(p)))
+    try:
+        sent = await tg(message.reply_media_group, media, prio=PRIO_BULK)
+    except Exception:
+        # протухший file_id валит всю группу — повторяем по URL
+        traceback.print_exc()
+        sent = await tg(message.reply_media_group, [InputMediaPhoto(p["image_url"], caption=product_caption(p)) for p in chunk], prio=PRIO_BULK)
+    for p, m in zip(chunk, sent or []):
+        if getattr(m, "photo", None):
+            _remember_photo(str(p.get("id") or p.get("sku")), p["image_url"], m.photo.file_id)
+    return True
 
 # ───────────── Парсеры каталогов (YML, CommerceML) ─────────────
 def _normalize_attr_name(n: str) -> str:
@@ -178,236 +798,859 @@ def _normalize_attr_name(n: str) -> str:
     }
     return replacements.get(n, n)
 
-def parse_tilda_yml(xml_bytes: bytes) -> list[dict]:
-    root = ET.fromstring(xml_bytes)
-    cat_map = {}
-    for c in root.findall(".//categories/category"):
-        cid = c.get("id") or ""
-        name = (c.text or "").strip()
-        if cid: cat_map[cid] = name
-    items = []
-    for o in root.findall(".//offers/offer"):
-        sku = o.get("id") or (o.findtext("vendorCode") or "")
-        name = o.findtext("name") or ""
-        brand = o.findtext("vendor") or ""
-        price = o.findtext("price")
-        img = o.findtext("picture") or ""
-        cat_id = o.findtext("categoryId") or ""
-        category = cat_map.get(cat_id, "") or "Без категории"
-
-        attrs = {}
-        for prm in o.findall("param"):
-            an = prm.get("name") or ""
-            av = (prm.text or "").strip()
-            if not an or not av: continue
-            attrs[_normalize_attr_name(an)] = av
-
-        low_blob = " ".join([name] + [f"{k}: {v}" for k,v in attrs.items()]).lower()
-        itype = "кабель" if "кабел" in low_blob else (
-            "автомат" if ("автомат" in low_blob or "выключат" in low_blob) else (
-                "пускатель" if "пускател" in low_blob else ""
-            )
-        )
-        amp = None; sqmm = None
-        m_amp = re.search(r"(\d{2,3})\s*а\b", low_blob)
-        if m_amp: amp = int(m_amp.group(1))
-        m_sq = re.search(r"(\d{1,3})\s*мм[²2]|\b(\d{1,3})\s*sqmm", low_blob)
-        if m_sq: sqmm = int([g for g in m_sq.groups() if g][0])
+# классификация: один проход по названию и свойствам товара, общий для YML и CommerceML
+_RE_AMP = re.compile(r"(\d{2,3})\s*а\b")
+_RE_SQMM = re.compile(r"(\d{1,3})\s*мм[²2]|\b(\d{1,3})\s*sqmm")
+_RE_COIL = re.compile(r"катушк\w*\D{0,30}?(\d{2,3})\s*[вv]\b")
+_RE_IP = re.compile(r"\bip\s*-?\s*(\d{2})\b")
+_RE_FIRST_INT = re.compile(r"\d{1,4}")
+_RE_IP_NUM = re.compile(r"\s*(\d{2})\s*")
+_CLASS_FIELDS = ("type", "amp", "sqmm", "coil_v", "ip")
+
+def classify(name: str, attrs: dict) -> tuple:
+    """(type, amp, sqmm, coil_v, ip) по названию и свойствам товара."""
+    low = " ".join([name] + [f"{k}: {v}" for k, v in attrs.items()]).lower()
+    itype = "кабель" if "кабел" in low else (
+        "автомат" if ("автомат" in low or "выключат" in low) else (
+            "пускатель" if "пускател" in low else ""))
+    m = _RE_AMP.search(low); amp = int(m.group(1)) if m else None
+    m = _RE_SQMM.search(low); sqmm = int(m.group(1) or m.group(2)) if m else None
+    # свойство надёжнее текста: «Катушка управления, В: ~230 AC» → 230
+    m = _RE_FIRST_INT.search(str(attrs.get("Катушка управления, В", ""))) or _RE_COIL.search(low)
+    coil = int(m.group(1) if m.re is _RE_COIL else m.group()) if m else None
+    ipv = str(attrs.get("Степень защиты, IP", "")).lower()
+    m = _RE_IP.search(ipv) or _RE_IP_NUM.fullmatch(ipv) or _RE_IP.search(low)
+    ip = int(m.group(1)) if m else None
+    return itype, amp, sqmm, coil, ip
+
+def classify_items(items, parallel=True):
+    # дописывает в товары поля _CLASS_FIELDS; на больших выгрузках — пулом процессов
+    names = [p["name"] for p in items]; attrs = [p["attrs"] for p in items]
+    if parallel and PARSE_WORKERS > 1 and len(items) >= CLASSIFY_POOL_MIN:
+        res = process_pool().map(classify, names, attrs, chunksize=2000)
+    else:
+        res = map(classify, names, attrs)
+    for p, r in zip(items, res):
+        p.update(zip(_CLASS_FIELDS, r))
+    return items
 
+@contextmanager
+def _feed(src):
+    # bytes / путь к файлу / открытый бинарный файл → файловый объект для iterparse
+    if isinstance(src, (bytes, bytearray, memoryview)):
+        yield BytesIO(src)
+    elif isinstance(src, (str, os.PathLike)):
+        with open(src, "rb") as f: yield f
+    else:
+        yield src
+
+def _iter_elements(f, wanted: dict):
+    """
+    Потоково отдаёт элементы wanted = {тег: тег_родителя} по событию end
+    вместе со стеком предков. После обработки элемент очищается и удаляется
+    из родителя, поэтому в памяти живёт один товар, а не всё дерево.
+    """
+    stack = []
+    for ev, el in ET.iterparse(f, events=("start", "end")):
+        if ev == "start":
+            stack.append(el); continue
+        stack.pop()
+        parent = stack[-1] if stack else None
+        if parent is None or wanted.get(el.tag) != parent.tag:
+            continue
+        yield el, stack
+        el.clear(); parent.remove(el)
+
+def parse_tilda_yml(src) -> list[dict]:
+    cat_map = {}; items = []; cat_ids = []
+    with _feed(src) as f:
+        for el, _ in _iter_elements(f, {"category": "categories", "offer": "offers"}):
+            if el.tag == "category":
+                cid = el.get("id") or ""
+                if cid: cat_map[cid] = (el.text or "").strip()
+                continue
+            o = el
+            sku = o.get("id") or (o.findtext("vendorCode") or "")
+            name = o.findtext("name") or ""
+            brand = o.findtext("vendor") or ""
+            price = o.findtext("price")
+            img = o.findtext("picture") or ""
+            cat_ids.append(o.findtext("categoryId") or "")
+
+            attrs = {}
+            for prm in o.findall("param"):
+                an = prm.get("name") or ""
+                av = (prm.text or "").strip()
+                if not an or not av: continue
+                attrs[_normalize_attr_name(an)] = av
+
+            items.append({
+                "id": sku or name, "sku": sku or name, "name": name,
+                "type": "", "brand": brand, "category": "",
+                "amp": None, "sqmm": None, "coil_v": None, "ip": None,
+                "price": float(price) if price else None,
+                "stock": None, "image_url": img,
+                "attrs": attrs
+            })
+    # categories в YML обычно идут до offers, но порядок не гарантирован
+    for it, cat_id in zip(items, cat_ids):
+        it["category"] = cat_map.get(cat_id, "") or "Без категории"
+    return classify_items(items)
+
+def _cml_attrs(node):
+    attrs = {}
+    for z in node.findall(".//ЗначенияСвойств/ЗначенияСвойства"):
+        an = z.findtext("Наименование") or ""
+        av = z.findtext("Значение") or ""
+        if an and av:
+            attrs[_normalize_attr_name(an)] = av.strip()
+    for z in node.findall(".//ХарактеристикиТовара/ХарактеристикаТовара"):
+        an = z.findtext("Наименование") or ""
+        av = z.findtext("Значение") or ""
+        if an and av:
+            attrs[_normalize_attr_name(an)] = av.strip()
+    return attrs
+
+def _cml_goods(t):
+    _id=(t.findtext("Ид") or "").strip()
+    name=(t.findtext("Наименование") or "").strip()
+    sku=(t.findtext("Артикул") or "") or _id
+    brand=(t.findtext("Изготовитель/Наименование") or t.findtext("Бренд") or "").strip()
+    image=(t.findtext("Картинка") or "").strip()
+    catref=t.find(".//Группы/Ид"); category=(catref.text or "").strip() if catref is not None else "Без категории"
+    attrs = _cml_attrs(t)
+    # type/amp/sqmm/coil_v/ip дописывает classify_items() после чтения всех документов
+    return _id, {"id":_id,"sku":sku,"name":name or sku,"brand":brand,"category":category,
+                 "image_url":image,"attrs":attrs}
+
+def _cml_offer(o):
+    _id=(o.findtext("Ид") or "").strip()
+    price=None; qnode=o.find(".//Цены/Цена/ЦенаЗаЕдиницу")
+    if qnode is not None and qnode.text:
+        try: price=float(qnode.text.replace(",", ".").strip())
+        except: price=None
+    stock=None; qty=o.find("Количество")
+    if qty is not None and qty.text:
+        try: stock=int(float(qty.text.replace(",", ".").strip()))
+        except: stock=None
+    return _id, {"price":price,"stock":stock}
+
+def _cml_parse_stream(f, cat_map, off_map, groups):
+    # один XML-документ: товары, группы и предложения читаются по одному элементу
+    for el, stack in _iter_elements(f, {"Товар": "Товары", "Группа": "Группы", "Предложение": "Предложения"}):
+        if el.tag == "Товар":
+            _id, v = _cml_goods(el)
+            if _id: cat_map[_id] = v
+        elif el.tag == "Группа":
+            gid=(el.findtext("Ид") or "").strip(); gname=(el.findtext("Наименование") or "").strip()
+            # вложенная группа: стек = [..., Группа-родитель, Группы]
+            parent = stack[-2] if len(stack) >= 2 and stack[-2].tag == "Группа" else None
+            pid = (parent.findtext("Ид") or "").strip() if parent is not None else ""
+            if gid and gname: groups[gid] = (gname, pid)
+        else:
+            _id, v = _cml_offer(el)
+            if _id: off_map[_id] = v
+
+def _cml_group_paths(groups):
+    # Ид группы -> "Родитель / … / Группа"; каждая группа разворачивается один раз
+    paths = {}
+    for gid in groups:
+        chain = []; cur = gid
+        while cur in groups and cur not in paths and cur not in chain:
+            chain.append(cur); cur = groups[cur][1]
+        prefix = paths.get(cur, "")
+        for g in reversed(chain):
+            prefix = paths[g] = f"{prefix} / {groups[g][0]}" if prefix else groups[g][0]
+    return paths
+
+def _cml_read_member(path, name):
+    # в процессе пула: один XML из ZIP-пакета, товары сразу классифицированы
+    cat_map, off_map, groups = {}, {}, {}
+    with zipfile.ZipFile(path) as z, z.open(name) as member:
+        _cml_parse_stream(member, cat_map, off_map, groups)
+    classify_items(list(cat_map.values()), parallel=False)
+    return cat_map, off_map, groups
+
+def _cml_read_zip_parallel(src, f, names):
+    # воркерам нужен путь: байты из HTTP-ответа один раз сбрасываются во временный файл
+    tmp = None
+    if isinstance(src, (str, os.PathLike)):
+        path = src
+    else:
+        f.seek(0)
+        with tempfile.NamedTemporaryFile(suffix=".zip", delete=False) as tmp:
+            shutil.copyfileobj(f, tmp)
+        path = tmp.name
+    try:
+        # map отдаёт результаты в порядке names — слияние не зависит от того, кто закончил первым
+        return list(process_pool().map(_cml_read_member, [path] * len(names), names))
+    finally:
+        if tmp is not None: os.unlink(tmp.name)
+
+def read_commerceml(src) -> tuple[dict, dict]:
+    """
+    Читает CommerceML (XML или ZIP-пакет обмена) и возвращает (товары, предложения):
+    {Ид: карточка товара} из import.xml и {Ид: {"price", "stock"}} из offers.xml.
+    Файлы ZIP-пакета при PARSE_WORKERS > 1 разбираются параллельно; более поздний
+    файл пакета, как и при последовательном чтении, перекрывает ранний.
+    """
+    cat_map, off_map, groups = {}, {}, {}
+    classified = False
+    with _feed(src) as f:
+        is_zip = zipfile.is_zipfile(f); f.seek(0)
+        if is_zip:
+            with zipfile.ZipFile(f) as z:
+                names = [n for n in z.namelist() if n.lower().endswith(".xml")]
+                if PARSE_WORKERS > 1 and len(names) > 1:
+                    for c, o, g in _cml_read_zip_parallel(src, f, names):
+                        cat_map.update(c); off_map.update(o); groups.update(g)
+                    classified = True
+                else:
+                    for name in names:
+                        with z.open(name) as member: _cml_parse_stream(member, cat_map, off_map, groups)
+        else:
+            _cml_parse_stream(f, cat_map, off_map, groups)
+
+    if not classified: classify_items(list(cat_map.values()))
+    # категория товара — имя его группы, путь от корня классификатора — в category_path
+    paths = _cml_group_paths(groups)
+    for v in cat_map.values():
+        gid = v["category"]
+        if gid in groups:
+            v["category"] = groups[gid][0]; v["category_path"] = paths[gid]
+    return cat_map, off_map
+
+def merge_commerceml(cat_map: dict, off_map: dict) -> list[dict]:
+    items=[]
+    for k in list(cat_map) + [k for k in off_map if k not in cat_map]:
+        base=cat_map.get(k,{}); price=off_map.get(k,{}).get("price"); stock=off_map.get(k,{}).get("stock")
         items.append({
-            "id": sku or name, "sku": sku or name, "name": name,
-            "type": itype, "brand": brand, "category": category,
-            "amp": amp, "sqmm": sqmm,
-            "price": float(price) if price else None,
-            "stock": None, "image_url": img,
-            "attrs": attrs
+            "id":base.get("id",k),"sku":base.get("sku",k),"name":base.get("name",k),
+            "type":base.get("type",""),"brand":base.get("brand",""),"category":base.get("category","Без категории"),
+            "category_path":base.get("category_path",""),
+            "amp":base.get("amp"),"sqmm":base.get("sqmm"),"coil_v":base.get("coil_v"),"ip":base.get("ip"),
+            "price":price,"stock":stock,
+            "image_url":base.get("image_url",""),
+            "attrs": base.get("attrs", {})
         })
     return items
 
-def parse_commerceml(xml_bytes: bytes) -> list[dict]:
-    def _attrs_from(root, node):
-        attrs = {}
-        for z in node.findall(".//ЗначенияСвойств/ЗначенияСвойства"):
-            an = z.findtext("Наименование") or ""
-            av = z.findtext("Значение") or ""
-            if an and av:
-                attrs[_normalize_attr_name(an)] = av.strip()
-        for z in node.findall(".//ХарактеристикиТовара/ХарактеристикаТовара"):
-            an = z.findtext("Наименование") or ""
-            av = z.findtext("Значение") or ""
-            if an and av:
-                attrs[_normalize_attr_name(an)] = av.strip()
-        return attrs
-
-    def _parse_catalog(root):
-        cat={}
-        for t in root.findall(".//Товары/Товар"):
-            _id=(t.findtext("Ид") or "").strip()
-            name=(t.findtext("Наименование") or "").strip()
-            sku=(t.findtext("Артикул") or "") or _id
-            brand=(t.findtext("Изготовитель/Наименование") or t.findtext("Бренд") or "").strip()
-            image=(t.findtext("Картинка") or "").strip()
-            catref=t.find(".//Группы/Ид"); category=(catref.text or "").strip() if catref is not None else "Без категории"
-            attrs = _attrs_from(root, t)
-
-            low = f"{name} {json.dumps(attrs, ensure_ascii=False)}".lower()
-            itype="кабель" if "кабел" in low else ("автомат" if ("автомат" in low or "выключат" in low) else ("пускатель" if "пускател" in low else ""))
-            amp=sqmm=None
-            m_amp=re.search(r"(\d{2,3})\s*а\b", low); m_sq=re.search(r"(\d{1,3})\s*мм[²2]|\b(\d{1,3})\s*sqmm", low)
-            if m_amp: amp=int(m_amp.group(1))
-            if m_sq:  sqmm=int([g for g in m_sq.groups() if g][0])
-            if _id:
-                cat[_id]={"id":_id,"sku":sku,"name":name or sku,"brand":brand,"category":category,
-                          "image_url":image,"type":itype,"amp":amp,"sqmm":sqmm,"attrs":attrs}
-        for g in root.findall(".//Группы/Группа"):
-            gid=(g.findtext("Ид") or "").strip(); gname=(g.findtext("Наименование") or "").strip()
-            if gid and gname:
-                for v in cat.values():
-                    if v.get("category")==gid: v["category"]=gname or "Без категории"
-        return cat
-
-    def _parse_offers(root):
-        offers={}
-        for o in root.findall(".//Предложения/Предложение"):
-            _id=(o.findtext("Ид") or "").strip()
-            if not _id: continue
-            price=None; qnode=o.find(".//Цены/Цена/ЦенаЗаЕдиницу")
-            if qnode is not None and qnode.text:
-                try: price=float(qnode.text.replace(",", ".").strip())
-                except: price=None
-            stock=None; qty=o.find("Количество")
-            if qty is not None and qty.text:
-                try: stock=int(float(qty.text.replace(",", ".").strip()))
-                except: stock=None
-            offers[_id]={"price":price,"stock":stock}
-        return offers
-
-    def _one(xml_b: bytes):
-        root=ET.fromstring(xml_b); cat_map=_parse_catalog(root); off_map=_parse_offers(root)
-        items=[]; keys=set(cat_map.keys())|set(off_map.keys())
+def parse_commerceml(src) -> list[dict]:
+    return merge_commerceml(*read_commerceml(src))
+
+# ───────────── Компактное хранение товаров ─────────────
+# На 100k товаров dict-на-товар с вложенным attrs держит сотни МБ: одни и те же
+# «Номинальный ток, А», категории и бренды лежат в каждом товаре. ProductStore
+# хранит каталог по колонкам: строки и прочие значения интернированы в _vals,
+# price/stock/amp/sqmm — в array("d"), attrs — парами (attr_id, value_id).
+# ProductRow — тонкое представление строки с интерфейсом dict только для чтения.
+_NUM_COLS = ("price", "stock", "amp", "sqmm")
+_K_NONE, _K_INT, _K_FLOAT, _K_VAL = 0, 1, 2, 3
+_ATTRS_PAIRS = 0   # id в колонке "attrs": словарь лежит парами
+
+def _vkey(v):
+    # ключ интернирования: 1, 1.0 и True не склеиваются, списки — по содержимому
+    if isinstance(v, list): return (list, tuple(_vkey(x) for x in v))
+    if isinstance(v, dict): return (dict, tuple((k, _vkey(x)) for k, x in v.items()))
+    try:
+        hash(v); return (type(v), v)
+    except TypeError:
+        return (object, id(v))
+
+class ProductStore:
+    def __init__(self, items=()):
+        self._vals = [None]; self._val_ids = {}
+        self._schemas = []; self._schema_ids = {}   # наборы ключей товара (порядок сохраняется)
+        self._schema = array("I")                   # № набора ключей для каждой строки
+        self._cols = {}                             # ключ -> array("I") id значений
+        self._nums = {k: array("d") for k in _NUM_COLS}
+        self._kinds = {k: bytearray() for k in _NUM_COLS}
+        self._attr_off = array("I", [0]); self._attr_ids = array("I"); self._attr_vals = array("I")
+        self._n = 0
+        for p in items: self._append(p)
+        # хранилище неизменяемо: словари интернирования больше не нужны
+        self._val_ids = self._schema_ids = None
+
+    def _vid(self, v) -> int:
+        k = _vkey(v); i = self._val_ids.get(k)
+        if i is None:
+            i = self._val_ids[k] = len(self._vals); self._vals.append(v)
+        return i
+
+    def _append(self, p):
+        i = self._n; keys = tuple(p.keys())
+        sid = self._schema_ids.get(keys)
+        if sid is None:
+            sid = self._schema_ids[keys] = len(self._schemas); self._schemas.append(dict.fromkeys(keys))
+        self._schema.append(sid)
+        for k in _NUM_COLS:
+            v = p[k] if k in p else None; t = type(v)
+            if v is None: kind, x = _K_NONE, 0.0
+            elif t is int and abs(v) < 2**53: kind, x = _K_INT, float(v)
+            elif t is float: kind, x = _K_FLOAT, v
+            else: kind, x = _K_VAL, float(self._vid(v))
+            self._nums[k].append(x); self._kinds[k].append(kind)
         for k in keys:
-            base=cat_map.get(k,{}); price=off_map.get(k,{}).get("price"); stock=off_map.get(k,{}).get("stock")
-            items.append({
-                "id":base.get("id",k),"sku":base.get("sku",k),"name":base.get("name",k),
-                "type":base.get("type",""),"brand":base.get("brand",""),"category":base.get("category","Без категории"),
-                "amp":base.get("amp"),"sqmm":base.get("sqmm"),"price":price,"stock":stock,
-                "image_url":base.get("image_url",""),
-                "attrs": base.get("attrs", {})
-            })
-        return items
-
-    if zipfile.is_zipfile(io.BytesIO(xml_bytes)):
-        with zipfile.ZipFile(io.BytesIO(xml_bytes)) as z:
-            cat_map, off_map = {}, {}
-            for name in z.namelist():
-                if not name.lower().endswith(".xml"): continue
-                data=z.read(name); root=ET.fromstring(data)
-                if root.findall(".//Товары/Товар"): cat_map.update({k:v for k,v in _parse_catalog(root).items()})
-                if root.findall(".//Предложения/Предложение"):
-                    for k,v in _parse_offers(root).items(): off_map[k]=v
-            items=[]; keys=set(cat_map.keys())|set(off_map.keys())
-            for k in keys:
-                base=cat_map.get(k,{}); price=off_map.get(k,{}).get("price"); stock=off_map.get(k,{}).get("stock")
-                items.append({
-                    "id":base.get("id",k),"sku":base.get("sku",k),"name":base.get("name",k),
-                    "type":base.get("type",""),"brand":base.get("brand",""),"category":base.get("category","Без категории"),
-                    "amp":base.get("amp"),"sqmm":base.get("sqmm"),"price":price,"stock":stock,
-                    "image_url":base.get("image_url",""),
-                    "attrs": base.get("attrs", {})
-                })
-            return items
-    return _one(xml_bytes)
+            if k in self._nums: continue
+            col = self._cols.get(k)
+            if col is None: col = self._cols[k] = array("I", bytes(4 * i))
+            v = p[k]
+            if k == "attrs" and type(v) is dict:
+                col.append(_ATTRS_PAIRS)
+                for an, av in v.items():
+                    self._attr_ids.append(self._vid(an)); self._attr_vals.append(self._vid(av))
+            else:
+                col.append(self._vid(v))
+        self._attr_off.append(len(self._attr_ids))
+        self._n = i + 1
+        for col in self._cols.values():
+            if len(col) < self._n: col.append(0)
+
+    def field(self, i, key):
+        if key in self._nums:
+            kind = self._kinds[key][i]; x = self._nums[key][i]
+            if kind == _K_INT: return int(x)
+            if kind == _K_FLOAT: return x
+            return self._vals[int(x)] if kind == _K_VAL else None
+        vid = self._cols[key][i]
+        if key == "attrs" and vid == _ATTRS_PAIRS:
+            a, b = self._attr_off[i], self._attr_off[i+1]; V = self._vals
+            return {V[an]: V[av] for an, av in zip(self._attr_ids[a:b], self._attr_vals[a:b])}
+        return self._vals[vid]
+
+    def __len__(self): return self._n
+
+    def __getitem__(self, i):
+        if isinstance(i, slice): return [ProductRow(self, j) for j in range(*i.indices(self._n))]
+        if i < 0: i += self._n
+        if not 0 <= i < self._n: raise IndexError(i)
+        return ProductRow(self, i)
+
+    def __iter__(self):
+        return (ProductRow(self, i) for i in range(self._n))
+
+class ProductRow(Mapping):
+    __slots__ = ("_s", "_i")
+    def __init__(self, store, i): self._s = store; self._i = i
+    def _keys(self): return self._s._schemas[self._s._schema[self._i]]
+    def __getitem__(self, key):
+        if key not in self._keys(): raise KeyError(key)
+        return self._s.field(self._i, key)
+    def get(self, key, default=None):
+        return self._s.field(self._i, key) if key in self._keys() else default
+    def __contains__(self, key): return key in self._keys()
+    def __iter__(self): return iter(self._keys())
+    def __len__(self): return len(self._keys())
+    def __repr__(self): return repr(dict(self))   # совпадает с repr исходного dict → те же хеши
+
+def compact_snapshot(snap):
+    # пересборка колонок целиком: индексы не меняются, позиции те же
+    if not CATALOG_COMPACT or isinstance(snap.items, ProductStore):
+        return snap
+    return snap._replace(items=ProductStore(snap.items))
 
 # ───────────── Индексация каталога ─────────────
-def rebuild_index():
-    global catalog_index
-    cats = [str(p.get("category","")).strip() or "Без категории" for p in catalog]
-    cat_counts = Counter(cats)
-    categories = [c for c,_ in cat_counts.most_common()]
-
-    brands_by_cat = defaultdict(Counter)
-    attrs_by_cat = defaultdict(lambda: defaultdict(Counter))
-
-    for p in catalog:
-        cat = str(p.get("category","")).strip() or "Без категории"
-        brand = (p.get("brand") or "").strip()
-        if brand: brands_by_cat[cat][brand] += 1
-        attrs = dict(p.get("attrs") or {})
-        if brand: attrs.setdefault("Бренд", brand)
-        if isinstance(p.get("stock"), (int,float)):
-            attrs.setdefault("Наличие", "В наличии" if p["stock"] > 0 else "Под заказ")
-        for an,av in attrs.items():
-            an_norm = _normalize_attr_name(an)
-            av_norm = str(av).strip()
-            if not an_norm or not av_norm: continue
-            attrs_by_cat[cat][an_norm][av_norm] += 1
-
-    steps_by_cat = {}
-    for cat, amap in attrs_by_cat.items():
-        keys = list(amap.keys())
-        def _key_rank(k):
-            if k.lower() == "бренд": return (0, -sum(amap[k].values()))
-            if k.lower() == "наличие": return (1, -sum(amap[k].values()))
-            return (2, -sum(amap[k].values()))
-        keys.sort(key=_key_rank)
-        steps_by_cat[cat] = keys
-
-    catalog_index = {
-        "categories": categories,
-        "brands_by_cat": brands_by_cat,
-        "attrs_by_cat": attrs_by_cat,
-        "attr_steps_by_cat": steps_by_cat,
-    }
+def _trigrams(s: str) -> set:
+    return {s[i:i+3] for i in range(len(s) - 2)}
+
+def _posting_has(post, i) -> bool:
+    j = bisect_left(post, i)
+    return j < len(post) and post[j] == i
+
+def _intersect(posts) -> list:
+    # пересечение отсортированных списков позиций: идём по самому короткому,
+    # остальные проверяем бинарным поиском — цена ~ размер самого редкого терма
+    if not posts: return []
+    posts = sorted(posts, key=len)
+    res = list(posts[0])
+    for p in posts[1:]:
+        if not res: break
+        res = [i for i in res if _posting_has(p, i)]
+    return res
+
+def _union(posts) -> list:
+    if not posts: return []
+    if len(posts) == 1: return list(posts[0])
+    return sorted(set().union(*posts))
+
+def _avail_key(stock) -> str:
+    if not isinstance(stock, (int,float)): return "unknown"
+    return "in" if stock > 0 else "out"
+
+def _item_terms(p):
+    """
+    Всё, что товар вносит в индекс: строка поиска, posting-ключи и счётчики.
+    Ключи — пути в индексе, последний элемент пути — ключ листа
+    (array позиций для postings, число для счётчиков).
+    """
+    cat = str(p.get("category","")).strip() or "Без категории"
+    ptype = str(p.get("type","")).lower(); brand_l = str(p.get("brand","")).lower()
+    head = f"{str(p.get('name','')).lower()} {str(p.get('sku','')).lower()} {brand_l}"
+    h = f"{head} {ptype}"
+
+    posts = {("trigrams", tg) for tg in _trigrams(h)}
+    posts.add(("by_type", ptype)); posts.add(("by_brand", brand_l))
+    amp = p.get("amp"); sq = p.get("sqmm")
+    if isinstance(amp, (int,float)): posts.add(("by_amp", amp)); posts.add(("num_by_type", "amp", ptype, amp))
+    if isinstance(sq, (int,float)): posts.add(("by_sqmm", sq)); posts.add(("num_by_type", "sqmm", ptype, sq))
+    coil = p.get("coil_v"); ip = p.get("ip")
+    if isinstance(coil, int): posts.add(("by_coil", coil))
+    if isinstance(ip, int): posts.add(("by_ip", ip))
+    # фасеты мастера: нормализация та же, что в _sel_posting
+    catn = _norm(p.get("category"))
+    posts.add(("facets", catn, "all"))
+    posts.add(("facets", catn, "brand", _norm(p.get("brand"))))
+    posts.add(("facets", catn, "avail", _avail_key(p.get("stock"))))
+    p_attrs = {_normalize_attr_name(k): v for k, v in (p.get("attrs") or {}).items()}
+    for an, av in p_attrs.items():
+        posts.add(("facets", catn, "attrs", an, _norm(av)))
+
+    counts = [("cat_counts", cat)]
+    brand = (p.get("brand") or "").strip()
+    if brand: counts.append(("brands_by_cat", cat, brand))
+    attrs = dict(p.get("attrs") or {})
+    if brand: attrs.setdefault("Бренд", brand)
+    if isinstance(p.get("stock"), (int,float)):
+        attrs.setdefault("Наличие", "В наличии" if p["stock"] > 0 else "Под заказ")
+    for an,av in attrs.items():
+        an_norm = _normalize_attr_name(an)
+        av_norm = str(av).strip()
+        if not an_norm or not av_norm: continue
+        counts.append(("attrs_by_cat", cat, an_norm, av_norm))
+    return cat, h, len(head), posts, counts
+
+def _attr_steps(amap) -> list:
+    def _key_rank(k):
+        if k.lower() == "бренд": return (0, -sum(amap[k].values()))
+        if k.lower() == "наличие": return (1, -sum(amap[k].values()))
+        return (2, -sum(amap[k].values()))
+    return sorted(amap.keys(), key=_key_rank)
+
+def _new_posting():
+    return array("I")
+
+class _IndexWriter:
+    """
+    Пишет индекс каталога. Без base строит с нуля; с base работает как
+    копирование при записи: копируются только контейнеры, которых касается
+    дельта, остальное новый индекс делит с base, который в это время читают.
+    """
+    def __init__(self, base=None):
+        self.fresh = base is None
+        self._owned = {}
+        # при сборке с нуля копий и удалений нет, а позиции идут по возрастанию:
+        # контейнеры и posting-листы кэшируются по пути, запись — просто append
+        self._nodes = {}; self._leaves = {}
+        self.index = {} if self.fresh else self._copy(base)
+        self.touched_cats = set()
+        self.touched_nums = set()   # (amp|sqmm, type), чьи отсортированные массивы пересобрать
+
+    def _touch_nums(self, posts):
+        self.touched_nums.update(path[1:3] for path in posts if path[0] == "num_by_type")
+
+    def _copy(self, obj):
+        c = array(obj.typecode, obj) if isinstance(obj, array) else type(obj)(obj)
+        self._owned[id(c)] = c
+        return c
+
+    def _child(self, node, key, factory):
+        cur = node.get(key)
+        if cur is None:
+            cur = node[key] = factory()
+            if not self.fresh: self._owned[id(cur)] = cur
+        elif not self.fresh and id(cur) not in self._owned:
+            cur = node[key] = self._copy(cur)
+        return cur
+
+    def _container(self, path, last=dict):
+        if self.fresh:
+            node = self._nodes.get(path)
+            if node is None:
+                node = self._nodes[path] = self._walk(path, last)
+            return node
+        return self._walk(path, last)
+
+    def _walk(self, path, last):
+        node = self.index
+        for k in path[:-1]: node = self._child(node, k, dict)
+        return self._child(node, path[-1], last)
+
+    def _existing(self, path):
+        # владеемые контейнеры по пути без создания недостающих
+        node = self.index; chain = []
+        for k in path:
+            if node.get(k) is None: return None, None
+            nxt = self._child(node, k, dict)
+            chain.append((node, k)); node = nxt
+        return chain, node
+
+    def _prune(self, chain):
+        # пустые контейнеры удаляются снизу вверх; таблицы верхнего уровня остаются
+        for parent, k in reversed(chain[1:]):
+            if parent[k]: break
+            del parent[k]
+
+    def _post(self, path, slot):
+        arr = self._child(self._container(path[:-1]), path[-1], _new_posting)
+        if not arr or arr[-1] < slot: arr.append(slot)
+        else: arr.insert(bisect_left(arr, slot), slot)
+
+    def _unpost(self, path, slot):
+        chain, arr = self._existing(path)
+        if arr is None: return
+        j = bisect_left(arr, slot)
+        if j < len(arr) and arr[j] == slot:
+            del arr[j]; self._prune(chain)
+
+    def _count(self, path, delta):
+        if delta > 0:
+            self._container(path[:-1], last=Counter)[path[-1]] += delta; return
+        chain, cnt = self._existing(path[:-1])
+        if cnt is None: return
+        cnt[path[-1]] += delta
+        if cnt[path[-1]] <= 0: del cnt[path[-1]]
+        self._prune(chain)
+
+    def _set_hay(self, slot, h, cut):
+        hay = self._child(self.index, "hay", list); hay_cut = self._child(self.index, "hay_cut", _new_posting)
+        if slot == len(hay): hay.append(h); hay_cut.append(cut)
+        else: hay[slot] = h; hay_cut[slot] = cut
+
+    def add(self, slot, p):
+        cat, h, cut, posts, counts = _item_terms(p)
+        self._set_hay(slot, h, cut)
+        if self.fresh:
+            leaves = self._leaves
+            for path in posts:
+                arr = leaves.get(path)
+                if arr is None:
+                    arr = leaves[path] = self._child(self._container(path[:-1]), path[-1], _new_posting)
+                arr.append(slot)
+        else:
+            for path in posts: self._post(path, slot)
+        for path in counts: self._count(path, 1)
+        self.touched_cats.add(cat)
+        if not self.fresh: self._touch_nums(posts)
+
+    def remove(self, slot, p):
+        cat, _, _, posts, counts = _item_terms(p)
+        for path in posts: self._unpost(path, slot)
+        for path in counts: self._count(path, -1)
+        self.touched_cats.add(cat); self._touch_nums(posts)
+
+    def replace(self, slot, old, new):
+        # товар на том же месте: трогаем только ключи, которые реально изменились
+        cat_o, _, _, posts_o, counts_o = _item_terms(old)
+        cat_n, h, cut, posts_n, counts_n = _item_terms(new)
+        self._set_hay(slot, h, cut)
+        for path in posts_o - posts_n: self._unpost(path, slot)
+        for path in posts_n - posts_o: self._post(path, slot)
+        delta = Counter(counts_n); delta.subtract(counts_o)
+        for path, d in delta.items():
+            if d: self._count(path, d)
+        self.touched_cats.update((cat_o, cat_n)); self._touch_nums(posts_o ^ posts_n)
+
+    def truncate(self, n):
+        del self._child(self.index, "hay", list)[n:]
+        del self._child(self.index, "hay_cut", _new_posting)[n:]
+
+    def finish(self) -> dict:
+        ix = self.index
+        for table in ("trigrams", "by_type", "by_brand", "by_amp", "by_sqmm", "by_coil", "by_ip", "num_by_type", "nearest",
+                      "facets", "brands_by_cat", "attrs_by_cat", "attr_steps_by_cat"):
+            ix.setdefault(table, {})
+        ix.setdefault("hay", []); ix.setdefault("hay_cut", _new_posting())
+        cat_counts = self._child(ix, "cat_counts", Counter)
+        ix["categories"] = [c for c,_ in cat_counts.most_common()]
+        if self.touched_cats or "cat_by_slug" not in ix:
+            ix["cat_by_slug"] = _slug_map(ix["categories"])
+        steps = self._child(ix, "attr_steps_by_cat", dict)
+        for cat in self.touched_cats:
+            amap = ix["attrs_by_cat"].get(cat)
+            if amap: steps[cat] = _attr_steps(amap)
+            else: steps.pop(cat, None)
+        # ближайшие по amp/sqmm: значения типа по возрастанию + позиции, для bisect
+        nums = ix["num_by_type"]
+        touched = ({(k, t) for k, types in nums.items() for t in types} if self.fresh else self.touched_nums)
+        if touched:
+            nearest = self._child(ix, "nearest", dict)
+            for key, t in touched:
+                by_val = nums.get(key, {}).get(t)
+                near = self._child(nearest, key, dict)
+                if not by_val:
+                    near.pop(t, None); continue
+                vals = array("d"); slots = array("I")
+                for v, post in sorted(by_val.items()):
+                    vals.extend([v] * len(post)); slots.extend(post)
+                near[t] = (vals, slots)
+        vocab = ix.get("intent_vocab")
+        if not vocab or vocab["src"] != (ix["by_type"].keys(), ix["by_brand"].keys()):
+            ix["intent_vocab"] = build_intent_vocab(ix["by_type"], ix["by_brand"])
+        return ix
+
+def _slug_map(keys) -> dict:
+    m = {}
+    for k in keys:
+        sl = cb_slug(k)
+        if m.setdefault(sl, k) != k: log.warning("Коллизия слагов %s: %r и %r", sl, m[sl], k)
+    return m
+
+def _product_hash(p) -> bytes:
+    # порядок ключей задаёт парсер и от выгрузки к выгрузке не меняется
+    return hashlib.blake2b(repr(p).encode(), digest_size=16).digest()
+
+def _sku_slots(items) -> dict:
+    by_sku = {}
+    for slot, p in enumerate(items): by_sku.setdefault(p.get("sku"), slot)
+    return by_sku
+
+def build_index(items, hashes=None) -> dict:
+    w = _IndexWriter()
+    for slot, p in enumerate(items): w.add(slot, p)
+    ix = w.finish()
+    ix["slot_by_id"] = {p.get("id"): slot for slot, p in enumerate(items)}
+    ix["slot_by_sku"] = _sku_slots(items)
+    ix["hash_by_id"] = hashes if hashes is not None else {p.get("id"): _product_hash(p) for p in items}
+    ix["id_by_slug"] = _slug_map(ix["slot_by_id"])
+    return ix
+
+class CatalogDelta(NamedTuple):
+    added: int = 0
+    removed: int = 0
+    modified: int = 0
+    full: bool = True    # индекс пересобран целиком
+
+    def __bool__(self):
+        return bool(self.added or self.removed or self.modified)
+
+    def summary(self) -> str:
+        how = "полная пересборка" if self.full else "дельта"
+        return f"+{self.added} новых, −{self.removed} удалено, ~{self.modified} изменено ({how})"
+
+DELTA_MAX_SHARE = 0.25   # больше изменений — дешевле пересобрать индекс целиком
+
+def apply_catalog(prev: CatalogSnapshot, items: list) -> tuple[CatalogSnapshot, CatalogDelta]:
+    """
+    Сравнивает новую выгрузку с прежним снапшотом по id и хешам содержимого
+    и обновляет индексы только для добавленных/удалённых/изменённых товаров.
+    Позиции остаются плотными: на место удалённого встаёт последний товар.
+    """
+    hashes = {p.get("id"): _product_hash(p) for p in items}
+    old_hashes = prev.index.get("hash_by_id") or {}
+    added = [k for k in hashes if k not in old_hashes]
+    removed = [k for k in old_hashes if k not in hashes]
+    modified = [k for k, h in hashes.items() if k in old_hashes and old_hashes[k] != h]
+    n_changed = len(added) + len(removed) + len(modified)
+    version = prev.version + 1
+
+    if (len(hashes) != len(items) or not prev.items
+            or n_changed > DELTA_MAX_SHARE * max(len(items), len(prev.items))):
+        delta = CatalogDelta(len(added), len(removed), len(modified), full=True)
+        return CatalogSnapshot(items=items, index=build_index(items, hashes), version=version), delta
+    delta = CatalogDelta(len(added), len(removed), len(modified), full=False)
+    if not delta:
+        return prev, delta
+
+    by_id = {p.get("id"): p for p in items}
+    cur = list(prev.items)
+    slot_by_id = dict(prev.index["slot_by_id"])
+    w = _IndexWriter(prev.index)
+    for pid in modified:
+        s = slot_by_id[pid]; w.replace(s, cur[s], by_id[pid]); cur[s] = by_id[pid]
+    for pid in removed:
+        s = slot_by_id.pop(pid); last = len(cur) - 1
+        w.remove(s, cur[s])
+        if s != last:
+            moved = cur[last]
+            w.remove(last, moved); w.add(s, moved)
+            cur[s] = moved; slot_by_id[moved.get("id")] = s
+        cur.pop()
+    w.truncate(len(cur))
+    for pid in added:
+        s = len(cur); cur.append(by_id[pid]); w.add(s, by_id[pid]); slot_by_id[pid] = s
+    ix = w.finish()
+    # артикулы в 1С повторяются: при правке владельца SKU словарь надо перевести на
+    # другой товар с тем же SKU — проще и надёжнее пересобрать его одним проходом
+    ix["slot_by_id"] = slot_by_id; ix["slot_by_sku"] = _sku_slots(cur); ix["hash_by_id"] = hashes
+    if added or removed:
+        id_by_slug = ix["id_by_slug"] = dict(prev.index.get("id_by_slug") or {})
+        for pid in removed: id_by_slug.pop(cb_slug(pid), None)
+        id_by_slug.update(_slug_map(added))
+    return CatalogSnapshot(items=cur, index=ix, version=version), delta
+
+def find_product(ref, snap=None):
+    # товар по id, а если такого id нет — по артикулу; O(1) по словарям индекса
+    snap = snap or _snapshot
+    s = snap.index.get("slot_by_id", {}).get(ref)
+    if s is None: s = snap.index.get("slot_by_sku", {}).get(ref)
+    return None if s is None else snap.items[s]
+
+def apply_offers(prev: CatalogSnapshot, offers: dict) -> tuple[CatalogSnapshot, CatalogDelta]:
+    """
+    Обмен только с offers.xml: цены и остатки вливаются в товары прежнего
+    снапшота на их же позициях. В индексе меняются лишь ключи наличия.
+    Предложения без товара в каталоге пропускаются — без import.xml у них нет карточки.
+    """
+    slot_by_id = prev.index.get("slot_by_id") or {}
+    cur = None; w = None; hashes = None; modified = 0; unknown = 0
+    for oid, o in offers.items():
+        s = slot_by_id.get(oid)
+        if s is None:
+            unknown += 1; continue
+        old = prev.items[s]
+        # пустое поле в предложении (например, выгрузка одних остатков) не затирает прежнее
+        upd = {k: v for k, v in o.items() if v is not None and old.get(k) != v}
+        if not upd: continue
+        if w is None:
+            cur = list(prev.items); w = _IndexWriter(prev.index); hashes = dict(prev.index["hash_by_id"])
+        new = {**old, **upd}
+        w.replace(s, old, new); cur[s] = new; hashes[oid] = _product_hash(new); modified += 1
+    if unknown:
+        log.info("offers.xml: %d предложений без товара в каталоге пропущено", unknown)
+    delta = CatalogDelta(modified=modified, full=False)
+    if w is None:
+        return prev, delta
+    ix = w.finish(); ix["hash_by_id"] = hashes
+    return CatalogSnapshot(items=cur, index=ix, version=prev.version + 1), delta
 
 # ───────────── Загрузка каталога + автонапоминания ─────────────
-def fetch_catalog(force=False):
-    global catalog, catalog_last_fetch, _catalog_etag, _catalog_last_modified
-    global _catalog_last_items, _catalog_last_change
+class _RefreshJob:
+    def __init__(self):
+        self.done = threading.Event(); self.result = False
+
+def _decode_body(src: str) -> str:
+    # Content-Encoding снимается уже с файла: Range при докачке считает сжатые байты
+    fd, dst = tempfile.mkstemp(prefix="catalog-", suffix=".body")
+    d = zlib.decompressobj(zlib.MAX_WBITS | 32)   # gzip или deflate в zlib-обёртке
+    try:
+        with open(src, "rb") as fi, os.fdopen(fd, "wb") as fo:
+            for chunk in iter(lambda: fi.read(CATALOG_CHUNK), b""):
+                fo.write(d.decompress(chunk))
+            fo.write(d.flush())
+    except BaseException:
+        os.unlink(dst); raise
+    return dst
+
+def download_catalog(headers: dict, auth):
+    """
+    Качает CATALOG_URL во временный файл и возвращает (первый ответ, путь к телу).
+    Тело пишется на диск как пришло; после обрыва запрос повторяется с Range
+    от записанного и If-Range по валидатору первого ответа, а если сервер вместо
+    206 ответил 200 — файл пишется заново. На 304 путь None. Файл удаляет вызывающий.
+    """
+    s = catalog_http()
+    fd, raw = tempfile.mkstemp(prefix="catalog-", suffix=".part")
+    first = None; tries = 0
+    try:
+        with os.fdopen(fd, "wb") as out:
+            while True:
+                got = out.tell(); h = headers
+                if first is not None and got:
+                    h = {"Range": f"bytes={got}-"}
+                    v = first.headers.get("ETag") or first.headers.get("Last-Modified")
+                    if v: h["If-Range"] = v
+                try:
+                    with s.get(CATALOG_URL, auth=auth, timeout=(20, 60), headers=h, stream=True) as r:
+                        resumed = (h is not headers and r.status_code == 206
+                                   and r.headers.get("Content-Range", "").startswith(f"bytes {got}-"))
+                        if not resumed:
+                            if r.status_code == 304 and first is None:
+                                first = r; break
+                            r.raise_for_status()
+                            first = r; out.seek(0); out.truncate()
+                        start = out.tell()
+                        for chunk in r.raw.stream(CATALOG_CHUNK, decode_content=False):
+                            out.write(chunk)
+                        size = r.headers.get("Content-Length")
+                        if size and size.isdigit() and out.tell() - start < int(size):
+                            raise requests.ConnectionError(f"оборвано на {out.tell()} байтах")
+                    break
+                except (requests.ConnectionError, requests.Timeout, Urllib3Error) as e:
+                    tries += 1
+                    if tries > CATALOG_RESUME_TRIES: raise
+                    log.warning("Загрузка каталога прервана (%s), докачка с %d байт", e, out.tell())
+        if first.status_code == 304:
+            os.unlink(raw); return first, None
+        enc = (first.headers.get("Content-Encoding") or "").strip().lower()
+        if enc in ("gzip", "x-gzip", "deflate"):
+            body = _decode_body(raw); os.unlink(raw); return first, body
+        if enc not in ("", "identity"):
+            raise ValueError(f"неподдерживаемый Content-Encoding: {enc}")
+        return first, raw
+    except BaseException:
+        os.unlink(raw); raise
 
+def fetch_catalog(force=False):
+    # single-flight: второй запрос во время загрузки не встаёт в очередь,
+    # а дожидается результата уже идущей (даже если та была без force)
+    global _refresh_job
     with catalog_lock:
-        now = datetime.now(timezone.utc)
-        if not force and catalog_last_fetch and now - catalog_last_fetch < timedelta(minutes=CATALOG_REFRESH_MIN):
-            return False
-        if not CATALOG_URL:
-            log.warning("CATALOG_URL не задан — пропускаю загрузку каталога")
-            return False
+        job = _refresh_job; owner = job is None
+        if owner: job = _refresh_job = _RefreshJob()
+    if not owner:
+        job.done.wait(); return job.result
+    try:
+        job.result = _fetch_catalog(force)
+    finally:
+        close_process_pool()
+        with catalog_lock: _refresh_job = None
+        job.done.set()
+    return job.result
+
+def _fetch_catalog(force):
+    global _snapshot, catalog_last_fetch, _catalog_etag, _catalog_last_modified
+    global _catalog_last_change
+
+    now = datetime.now(timezone.utc)
+    if not force and catalog_last_fetch and now - catalog_last_fetch < timedelta(minutes=CATALOG_REFRESH_MIN):
+        return False
+    if not CATALOG_URL:
+        log.warning("CATALOG_URL не задан — пропускаю загрузку каталога")
+        return False
+
+    headers = {}
+    if _catalog_etag: headers["If-None-Match"] = _catalog_etag
+    if _catalog_last_modified: headers["If-Modified-Since"] = _catalog_last_modified
+    auth = (CATALOG_AUTH_USER, CATALOG_AUTH_PASS) if CATALOG_AUTH_USER else None
+
+    body = None
+    try:
+        try:
+            h = catalog_http().head(CATALOG_URL, auth=auth, timeout=20)
+            if h.status_code in (200, 304):
+                lm = h.headers.get("Last-Modified"); et = h.headers.get("ETag")
+                if not force and et and _catalog_etag and et == _catalog_etag:
+                    catalog_last_fetch = now; return False
+                if not force and lm and _catalog_last_modified and lm == _catalog_last_modified:
+                    catalog_last_fetch = now; return False
+        except Exception:
+            pass
 
-        headers = {}
-        if _catalog_etag: headers["If-None-Match"] = _catalog_etag
-        if _catalog_last_modified: headers["If-Modified-Since"] = _catalog_last_modified
-        auth = (CATALOG_AUTH_USER, CATALOG_AUTH_PASS) if CATALOG_AUTH_USER else None
+        r, body = download_catalog(headers, auth)
+        if body is None:
+            catalog_last_fetch = now; return False
 
-        try:
+        ct = (r.headers.get("content-type") or "").lower()
+        url_l = CATALOG_URL.lower()
+
+        offers_only = None
+        if "xml" in ct and url_l.endswith(".yml"):
+            items = parse_tilda_yml(body)
+        elif "xml" in ct or "zip" in ct or url_l.endswith((".xml", ".zip")):
             try:
-                h = requests.head(CATALOG_URL, auth=auth, timeout=20)
-                if h.status_code in (200, 304):
-                    lm = h.headers.get("Last-Modified"); et = h.headers.get("ETag")
-                    if not force and et and _catalog_etag and et == _catalog_etag:
-                        catalog_last_fetch = now; return False
-                    if not force and lm and _catalog_last_modified and lm == _catalog_last_modified:
-                        catalog_last_fetch = now; return False
-            except Exception:
-                pass
-
-            r = requests.get(CATALOG_URL, auth=auth, timeout=60, headers=headers)
-            if r.status_code == 304:
-                catalog_last_fetch = now; return False
-            r.raise_for_status()
-
-            ct = (r.headers.get("content-type") or "").lower()
-            url_l = CATALOG_URL.lower()
-
-            if "xml" in ct and url_l.endswith(".yml"):
-                items = parse_tilda_yml(r.content)
-            elif "xml" in ct or "zip" in ct or url_l.endswith((".xml", ".zip")):
-                try: items = parse_commerceml(r.content)
-                except Exception: items = parse_tilda_yml(r.content)
-            elif "application/json" in ct or url_l.endswith(".json"):
-                data = r.json()
-                if not isinstance(data, list): log.error("JSON корень не список"); return False
-                items = data
-            elif "text/csv" in ct or url_l.endswith(".csv"):
-                f = io.StringIO(r.text); reader = csv.DictReader(f); items=[]
+                cat_map, off_map = read_commerceml(body)
+                if not cat_map and not off_map: raise ValueError("в XML нет ни товаров, ни предложений")
+                # обмен из 1С только с offers.xml: цены/остатки без карточек товаров
+                if off_map and not cat_map: offers_only = off_map
+                else: items = merge_commerceml(cat_map, off_map)
+            except Exception: items = parse_tilda_yml(body)
+        elif "application/json" in ct or url_l.endswith(".json"):
+            with open(body, "rb") as f: data = json.load(f)
+            if not isinstance(data, list): log.error("JSON корень не список"); return False
+            items = data
+        elif "text/csv" in ct or url_l.endswith(".csv"):
+            with open(body, encoding=r.encoding or "utf-8", errors="replace", newline="") as f:
+                reader = csv.DictReader(f); items=[]
                 for row in reader:
                     def _i(v):
                         try: return int(str(v).strip().replace(" ", "")) if str(v).strip() else None
@@ -427,9 +1670,14 @@ def fetch_catalog(force=False):
                         "image_url": row.get("image_url") or row.get("image") or row.get("Image"),
                         "attrs": {}
                     })
-            else:
-                log.error("Неизвестный формат каталога: %s", ct or url_l); return False
+        else:
+            log.error("Неизвестный формат каталога: %s", ct or url_l); return False
 
+        if offers_only is not None:
+            if not _snapshot.items:
+                log.warning("Пришли только предложения (offers.xml), а каталога ещё нет — пропускаю"); return False
+            new_snap, delta = apply_offers(_snapshot, offers_only)
+        else:
             norm=[]
             for p in items:
                 if not p or not p.get("name"): 
@@ -439,36 +1687,44 @@ def fetch_catalog(force=False):
                 p.setdefault("brand",""); p.setdefault("category","Без категории"); p.setdefault("type","")
                 p.setdefault("attrs", {})
                 norm.append(p)
-            catalog = norm
-            catalog_last_fetch = now
-
-            new_etag = r.headers.get("ETag"); new_lm = r.headers.get("Last-Modified")
-            if new_etag: _catalog_etag = new_etag
-            if new_lm: _catalog_last_modified = new_lm
-
-            changed = (len(catalog) != _catalog_last_items)
-            _catalog_last_items = len(catalog)
-            if changed: _catalog_last_change = now
-
-            rebuild_index()
-
-            log.info("Каталог обновлён: %d позиций (из %s)", len(catalog), CATALOG_URL)
-
-            if AUTOSYNC_NOTIFY and TELEGRAM_ADMIN_ID and changed:
-                try:
-                    if getattr(app, "is_connected", False):
-                        app.send_message(
-                            TELEGRAM_ADMIN_ID,
-                            f"✅ Каталог обновлён: {len(catalog)} позиций\nИсточник: {CATALOG_URL}"
-                        )
-                except Exception:
-                    traceback.print_exc()
-            return True
+            new_snap, delta = apply_catalog(_snapshot, norm)
+        # индекс строится в стороне, публикация — одно присваивание ссылки
+        new_snap = compact_snapshot(new_snap)
+        _snapshot = new_snap
+        catalog_last_fetch = now
+
+        new_etag = r.headers.get("ETag"); new_lm = r.headers.get("Last-Modified")
+        validators_changed = (new_etag or _catalog_etag, new_lm or _catalog_last_modified) != (_catalog_etag, _catalog_last_modified)
+        if new_etag: _catalog_etag = new_etag
+        if new_lm: _catalog_last_modified = new_lm
+
+        changed = bool(delta)
+        if changed:
+            _catalog_last_change = now
+            # кэш фото пишет и таймер на цикле бота — чистим там же, без второго писателя
+            if getattr(app, "is_connected", False): app.loop.call_soon_threadsafe(prune_photo_cache, new_snap)
+            else: prune_photo_cache(new_snap)
+        if changed or validators_changed:
+            save_catalog_state(new_snap)
+
+        log.info("Каталог обновлён: %d позиций (из %s), %s", len(new_snap.items), CATALOG_URL, delta.summary())
+
+        if AUTOSYNC_NOTIFY and TELEGRAM_ADMIN_ID and changed:
+            try:
+                notify(TELEGRAM_ADMIN_ID,
+                       f"✅ Каталог обновлён: {len(new_snap.items)} позиций\n"
+                       f"Изменения: {delta.summary()}\nИсточник: {CATALOG_URL}")
+            except Exception:
+                traceback.print_exc()
+        return True
 
-        except Exception as e:
-            traceback.print_exc()
-            log.error("Ошибка загрузки каталога: %s", e)
-            return False
+    except Exception as e:
+        traceback.print_exc()
+        log.error("Ошибка загрузки каталога: %s", e)
+        return False
+    finally:
+        # тело уже разобрано в снапшот — временный файл больше не нужен
+        if body: os.unlink(body)
 
 def periodic_refresh():
     global _last_reminder_at
@@ -483,17 +1739,91 @@ def periodic_refresh():
                 if not updated and due_change and due_rem:
                     try:
                         if getattr(app, "is_connected", False):
-                            app.send_message(
-                                TELEGRAM_ADMIN_ID,
-                                "ℹ️ Каталог не обновлялся. Если в Tilda есть новые данные из 1С, "
-                                "нажми «Начать экспорт» в Tilda, затем «Обновить каталог» в боте."
-                            )
+                            notify(TELEGRAM_ADMIN_ID,
+                                   "ℹ️ Каталог не обновлялся. Если в Tilda есть новые данные из 1С, "
+                                   "нажми «Начать экспорт» в Tilda, затем «Обновить каталог» в боте.")
                             _last_reminder_at = now
                     except Exception:
                         traceback.print_exc()
+        if getattr(app, "is_connected", False):
+            app.loop.call_soon_threadsafe(save_sessions)
     finally:
         threading.Timer(CATALOG_REFRESH_MIN * 60, periodic_refresh).start()
 
+# ───────────── Состояние на диске ─────────────
+# Снапшот (товары + готовые индексы) пишется после каждого изменения; на старте
+# бот сразу отвечает по нему, а каталог перепроверяется с ETag в фоне.
+_STATE_FORMAT = 7   # поднять при несовместимом изменении формата индекса
+
+def _dump_pickle(path, obj):
+    os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+    tmp = path + ".tmp"
+    with open(tmp, "wb") as f:
+        pickle.dump(obj, f, protocol=pickle.HIGHEST_PROTOCOL)
+    os.replace(tmp, path)
+
+def _load_pickle(path):
+    try:
+        with open(path, "rb") as f:
+            return pickle.load(f)
+    except FileNotFoundError:
+        return None
+    except Exception:
+        traceback.print_exc(); return None
+
+def save_catalog_state(snap=None):
+    snap = snap or _snapshot
+    if not snap.items: return
+    try:
+        # tuple() и __dict__, а не сами классы: они живут то в __main__, то в bot
+        items = {"store": snap.items.__dict__} if isinstance(snap.items, ProductStore) else snap.items
+        _dump_pickle(CATALOG_STATE_PATH, {
+            "format": _STATE_FORMAT, "url": CATALOG_URL, "snapshot": (items, *snap[1:]),
+            "etag": _catalog_etag, "last_modified": _catalog_last_modified,
+            "last_change": _catalog_last_change,
+        })
+    except Exception:
+        traceback.print_exc()
+
+def load_catalog_state() -> bool:
+    global _snapshot, _catalog_etag, _catalog_last_modified, _catalog_last_change
+    st = _load_pickle(CATALOG_STATE_PATH)
+    if not isinstance(st, dict) or st.get("format") != _STATE_FORMAT or st.get("url") != CATALOG_URL:
+        return False
+    items, *rest = st["snapshot"]
+    if isinstance(items, dict):
+        store = ProductStore.__new__(ProductStore); store.__dict__.update(items["store"]); items = store
+    _snapshot = compact_snapshot(CatalogSnapshot(items, *rest))
+    _catalog_etag = st.get("etag"); _catalog_last_modified = st.get("last_modified")
+    _catalog_last_change = st.get("last_change")
+    log.info("Каталог восстановлен с диска: %d позиций (ETag %s)", len(_snapshot.items), _catalog_etag or "—")
+    return True
+
+def save_sessions():
+    # вызывать из потока бота: хранилища сессий меняются только там
+    try:
+        _dump_pickle(SESSIONS_STATE_PATH, {
+            "format": _STATE_FORMAT, "saved_at": time.time(),
+            "wiz2": WIZ2.dump(), "pending_reserve": pending_reserve.dump(),
+        })
+    except Exception:
+        traceback.print_exc()
+
+def load_sessions():
+    st = _load_pickle(SESSIONS_STATE_PATH)
+    if not isinstance(st, dict) or st.get("format") != _STATE_FORMAT: return
+    elapsed = max(0.0, time.time() - st.get("saved_at", 0))
+    WIZ2.load(st.get("wiz2") or [], elapsed)
+    pending_reserve.load(st.get("pending_reserve") or [], elapsed)
+    log.info("Сессии восстановлены: мастер %d, брони %d", len(WIZ2), len(pending_reserve))
+
+def revalidate_catalog():
+    # фоновая проверка восстановленного каталога: If-None-Match/If-Modified-Since → чаще всего 304
+    try:
+        fetch_catalog(force=True)
+    finally:
+        periodic_refresh()
+
 # ───────────── HTTP-хук ─────────────
 class _HookHandler(BaseHTTPRequestHandler):
     def do_GET(self):
@@ -506,8 +1836,8 @@ class _HookHandler(BaseHTTPRequestHandler):
                 self.send_response(401); self.end_headers(); self.wfile.write(b"Unauthorized"); return
             ok = fetch_catalog(force=True)
             try:
-                if TELEGRAM_ADMIN_ID and getattr(app, "is_connected", False):
-                    app.send_message(TELEGRAM_ADMIN_ID, ("✅ Каталог обновлён немедленно" if ok else "ℹ️ Каталог не изменился (304)") + f"\nИсточник: {CATALOG_URL}")
+                if TELEGRAM_ADMIN_ID:
+                    notify(TELEGRAM_ADMIN_ID, ("✅ Каталог обновлён немедленно" if ok else "ℹ️ Каталог не изменился (304)") + f"\nИсточник: {CATALOG_URL}")
             except Exception:
                 traceback.print_exc()
             self.send_response(200); self.end_headers(); self.wfile.write(b"OK")
@@ -525,123 +1855,230 @@ def _run_http_server():
         traceback.print_exc()
 
 # ───────────── Поиск / намерение ─────────────
-INTENT = re.compile(
-    r"(?P<what>кабель|провод|автомат|выключател[ьяь]|пускател[ьяи])?"
-    r".*?(?P<num>\d{1,3})\s*(?P<unit>мм2|мм²|мм|sqmm|а|a)?",
-    re.IGNORECASE
-)
-def parse_intent(text: str):
-    t = (text or "").lower(); brand=None
-    for b in ("abb","schneider","iek","legrand","hager","siemens","rexant","sevkabel"):
-        if b in t: brand=b; break
-    itype=sqmm=amp=None; m=INTENT.search(t)
+# словарь намерений: типы и бренды из самого каталога + встроенные синонимы,
+# собранные в регулярки-префиксные деревья (пересобираются в finish()
+# индекса только при смене набора типов/брендов). Как и прежняя INTENT, тип
+# по слову берётся, только если сообщение с него начинается и в нём есть
+# число: «кабель медный» или вопрос с упоминанием автомата уходят дальше, к LLM.
+_TYPE_STEMS = {"кабель": "кабель", "провод": "кабель", "автомат": "автомат",
+               "выключател": "автомат", "пускател": "пускатель"}
+_BASE_BRANDS = ("abb","schneider","iek","legrand","hager","siemens","rexant","sevkabel")
+_NUM_RE = re.compile(r"(\d{1,3})\s*(мм2|мм²|мм|sqmm|а|a)?")
+_COIL_Q_RE = re.compile(r"(?<!\d)(\d{2,3})\s*[вv]\b")
+INTENT_CACHE_MAX = 4096
+
+def _trie_pattern(words) -> str:
+    # общий префикс проверяется один раз; из вариантов берётся самый длинный
+    trie = {}
+    for w in words:
+        node = trie
+        for ch in w: node = node.setdefault(ch, {})
+        node[""] = None
+    def emit(node):
+        alts = [re.escape(ch) + emit(sub) for ch, sub in sorted(node.items()) if ch]
+        if not alts: return ""
+        body = alts[0] if len(alts) == 1 else "(?:" + "|".join(alts) + ")"
+        return f"(?:{body})?" if "" in node else body
+    return emit(trie)
+
+def build_intent_vocab(types=(), brands=()) -> dict:
+    type_words = dict(_TYPE_STEMS)   # слово -> канонический тип
+    for t in types:
+        t = t.strip()
+        if len(t) < 3: continue
+        # «кабель ввг» остаётся кабелем, «контактор» — сам себе тип
+        type_words.setdefault(t, next((c for stem, c in _TYPE_STEMS.items() if stem in t), t))
+    brand_words = [b.strip() for b in (*_BASE_BRANDS, *brands) if len(b.strip()) >= 2]
+    # тип — основа слова («выключател|ь|я»), бренд — целое слово: «ekfx» не EKF
+    return {"type_re": re.compile(_trie_pattern(type_words)), "types": type_words,
+            "brand_re": re.compile(r"(?<!\w)(?:" + _trie_pattern(brand_words) + r")(?!\w)"),
+            "src": (frozenset(types), frozenset(brands))}
+
+_BASE_VOCAB = build_intent_vocab()
+_intent_cache = OrderedDict()   # (версия снапшота, текст) -> намерение
+
+def parse_intent(text: str, snap=None):
+    snap = snap or _snapshot
+    t = " ".join((text or "").lower().split()); key = (snap.version, t)
+    hit = _intent_cache.get(key)
+    if hit is not None:
+        _intent_cache.move_to_end(key); return dict(hit)
+    vocab = snap.index.get("intent_vocab") or _BASE_VOCAB
+    sqmm = amp = None
+    m = vocab["brand_re"].search(t); brand = m.group() if m else None
+    m = _NUM_RE.search(t)
+    tm = vocab["type_re"].match(t) if m else None
+    itype = vocab["types"][tm.group()] if tm else None
     if m:
-        what=(m.group("what") or ""); unit=(m.group("unit") or "").lower()
-        try: n=int(m.group("num"))
-        except: n=None
-        if what.startswith("кабель") or "провод" in what: itype="кабель"
-        elif what.startswith("автомат") or "выключател" in what: itype="автомат"
-        elif "пускател" in what: itype="пускатель"
-        if n is not None:
-            if unit in ("мм2","мм²","мм","sqmm"): sqmm=n; itype=itype or "кабель"
-            elif unit in ("а","a"): amp=n; itype=itype or "автомат"
-    return {"type": itype, "sqmm": sqmm, "amp": amp, "brand": brand}
-
-def search_products(q, limit=10):
-    q=(q or "").strip().lower(); res=[]
-    for it in catalog:
-        hay=f"{str(it.get('name','')).lower()} {str(it.get('sku','')).lower()} {str(it.get('brand','')).lower()}"
-        if q in hay:
-            res.append(it)
+        n = int(m.group(1)); unit = m.group(2) or ""
+        if unit in ("мм2","мм²","мм","sqmm"): sqmm=n; itype=itype or "кабель"
+        elif unit in ("а","a"): amp=n; itype=itype or "автомат"
+    m = _COIL_Q_RE.search(t); coil = int(m.group(1)) if m else None
+    m = _RE_IP.search(t); ip = int(m.group(1)) if m else None
+    res = {"type": itype, "sqmm": sqmm, "amp": amp, "brand": brand, "coil_v": coil, "ip": ip}
+    if len(t) <= 512:   # длинные простыни не кэшируем: повторяются редко, а память занимают
+        _intent_cache[key] = res
+        while len(_intent_cache) > INTENT_CACHE_MAX: _intent_cache.popitem(last=False)
+    return dict(res)
+
+def _substring_candidates(q: str, idx: dict) -> list:
+    # позиции товаров, у которых q входит в "name sku brand type"
+    hay = idx.get("hay") or []
+    if len(q) < 3:
+        return [i for i, h in enumerate(hay) if q in h]
+    tri = idx.get("trigrams") or {}; posts = []
+    for tg in _trigrams(q):
+        post = tri.get(tg)
+        if not post: return []
+        posts.append(post)
+    return [i for i in _intersect(posts) if q in hay[i]]
+
+def search_products(q, limit=10, snap=None):
+    snap=snap or _snapshot; q=(q or "").strip().lower(); res=[]
+    if not q: return snap.items[:limit]
+    idx=snap.index; cut=idx.get("hay_cut") or array("I"); hay=idx.get("hay") or []
+    for i in _substring_candidates(q, idx):
+        if hay[i].find(q, 0, cut[i]) != -1:
+            res.append(snap.items[i])
             if len(res)>=limit: break
     return res
 
-def search_products_smart(qtext: str, limit=10):
-    intent=parse_intent(qtext); q=(qtext or "").strip().lower(); scored=[]
-    for p in catalog:
-        name=str(p.get("name","")).lower(); sku=str(p.get("sku","")).lower()
-        brand=str(p.get("brand","")).lower(); ptype=str(p.get("type","")).lower()
-        amp=p.get("amp"); sq=p.get("sqmm"); score=0
-        if intent["type"]:
-            if intent["type"] not in ptype: continue
-            score+=2
-        if intent["amp"] and isinstance(amp,(int,float)):
-            score+=3 if amp==intent["amp"] else (2 if abs(amp-intent["amp"])<=10 else 0)
-        if intent["sqmm"] and isinstance(sq,(int,float)):
-            score+=3 if sq==intent["sqmm"] else (2 if abs(sq-intent["sqmm"])<=5 else 0)
-        if intent["brand"] and intent["brand"] in brand: score+=2
-        if q and q in f"{name} {sku} {brand} {ptype}": score+=1
-        if score>0: scored.append((score,p))
-    if not scored: return search_products(qtext, limit=limit)
-    scored.sort(key=lambda x:x[0], reverse=True)
-    return [p for _,p in scored[:limit]]
-
-def suggest_alternatives(intent, limit=6):
+# inline-режим: запросы приходят на каждое нажатие клавиши, поэтому полный
+# список совпадений кэшируется по (версия, запрос), а «ка» → «каб» → «кабе»
+# фильтрует уже найденное для самого длинного закэшированного префикса
+_inline_cache = OrderedDict()  # (version, q) -> [позиции]
+
+def inline_matches(q: str, snap=None) -> list:
+    snap=snap or _snapshot; q=(q or "").strip().lower()
+    if not q: return range(len(snap.items))
+    key=(snap.version, q); hit=_inline_cache.get(key)
+    if hit is not None:
+        _inline_cache.move_to_end(key); return hit
+    idx=snap.index; cut=idx.get("hay_cut") or array("I"); hay=idx.get("hay") or []
+    prev=None
+    for n in range(len(q)-1, 0, -1):
+        prev=_inline_cache.get((snap.version, q[:n]))
+        if prev is not None: break
+    if prev is not None and (len(q) < 3 or len(prev) <= INLINE_REFILTER_MAX):
+        cand=prev   # совпадения q — подмножество совпадений его префикса
+    else:
+        cand=_substring_candidates(q, idx)
+    res=[i for i in cand if hay[i].find(q, 0, cut[i]) != -1]
+    _inline_cache[key]=res
+    while len(_inline_cache) > INLINE_CACHE_MAX: _inline_cache.popitem(last=False)
+    return res
+
+def _smart_score(p, h, intent, q) -> int:
+    amp=p.get("amp"); sq=p.get("sqmm"); score=0
+    if intent["type"]: score+=2
+    if intent["amp"] and isinstance(amp,(int,float)):
+        score+=3 if amp==intent["amp"] else (2 if abs(amp-intent["amp"])<=10 else 0)
+    if intent["sqmm"] and isinstance(sq,(int,float)):
+        score+=3 if sq==intent["sqmm"] else (2 if abs(sq-intent["sqmm"])<=5 else 0)
+    if intent["brand"] and intent["brand"] in str(p.get("brand","")).lower(): score+=2
+    if intent.get("coil_v") and p.get("coil_v")==intent["coil_v"]: score+=2
+    if intent.get("ip") and p.get("ip")==intent["ip"]: score+=1
+    if q and q in h: score+=1
+    return score
+
+def _smart_by_type(intent, q, limit, snap):
+    # у всех товаров типа score≥2; больше — только у попавших в окно amp/sqmm
+    # (bisect по отсортированным массивам), совпавших по бренду, катушке, IP или подстроке.
+    # Их и считаем, остаток добираем товарами типа по порядку каталога.
+    idx=snap.index; hay=idx.get("hay") or []
+    tposts={t:s for t,s in idx.get("by_type",{}).items() if intent["type"] in t}
+    if not tposts: return search_products(q, limit=limit, snap=snap)
+    boosted=set()
+    for key,w in (("amp",10),("sqmm",5)):
+        target=intent[key]
+        if not target: continue
+        near=idx.get("nearest",{}).get(key,{})
+        for t in tposts:
+            vals,slots=near.get(t) or ((),())
+            boosted.update(slots[bisect_left(vals, target-w):bisect_right(vals, target+w)])
+    posts=[]
+    if intent["brand"]: posts+=[s for b,s in idx.get("by_brand",{}).items() if intent["brand"] in b]
+    for key,table in (("coil_v","by_coil"),("ip","by_ip")):
+        if intent.get(key) and intent[key] in idx.get(table,{}): posts.append(idx[table][intent[key]])
+    for s in posts:
+        for tp in tposts.values(): boosted.update(_intersect([s, tp]))
+    if q:
+        boosted.update(i for i in _substring_candidates(q, idx) if any(_posting_has(tp, i) for tp in tposts.values()))
+    scored=[(_smart_score(snap.items[i], hay[i], intent, q), i) for i in sorted(boosted)]
+    res=[snap.items[i] for _,i in heapq.nlargest(limit, scored, key=lambda x:x[0])]
+    if len(res)<limit:
+        for i in heapq.merge(*tposts.values()):
+            if i in boosted: continue
+            res.append(snap.items[i])
+            if len(res)>=limit: break
+    return res
+
+def search_products_smart(qtext: str, limit=10, snap=None):
+    snap=snap or _snapshot; idx=snap.index
+    intent=parse_intent(qtext, snap); q=(qtext or "").strip().lower()
+    if intent["type"]: return _smart_by_type(intent, q, limit, snap)
+    # кандидаты из индекса: объединение всего, что может дать score>0
+    posts=[]
+    if intent["amp"]:
+        posts+=[s for v,s in idx.get("by_amp",{}).items() if abs(v-intent["amp"])<=10]
+    if intent["sqmm"]:
+        posts+=[s for v,s in idx.get("by_sqmm",{}).items() if abs(v-intent["sqmm"])<=5]
+    if intent["brand"]:
+        posts+=[s for b,s in idx.get("by_brand",{}).items() if intent["brand"] in b]
+    for key,table in (("coil_v","by_coil"),("ip","by_ip")):
+        if intent.get(key) and intent[key] in idx.get(table,{}): posts.append(idx[table][intent[key]])
+    if q: posts.append(_substring_candidates(q, idx))
+    hay=idx.get("hay") or []; scored=[]
+    for i in _union(posts):
+        score=_smart_score(snap.items[i], hay[i], intent, q)
+        if score>0: scored.append((score,snap.items[i]))
+    if not scored: return search_products(qtext, limit=limit, snap=snap)
+    return [p for _,p in heapq.nlargest(limit, scored, key=lambda x:x[0])]
+
+def _closest(vals, slots, target, n) -> list:
+    # от точки вставки target расходимся в обе стороны; равные по расстоянию
+    # с n-м тоже берём, чтобы при слиянии типов порядок совпал с полным сортом
+    hi=bisect_left(vals, target); lo=hi-1; out=[]
+    while lo>=0 or hi<len(vals):
+        if hi>=len(vals) or (lo>=0 and target-vals[lo]<=vals[hi]-target):
+            d=target-vals[lo]; i=slots[lo]; lo-=1
+        else:
+            d=vals[hi]-target; i=slots[hi]; hi+=1
+        if len(out)>=n and d>out[-1][0]: break
+        out.append((d, i))
+    return out
+
+def suggest_alternatives(intent, limit=6, snap=None):
+    snap=snap or _snapshot
     if not intent["type"]: return []
     key="amp" if intent["type"] in ("автомат","пускатель") else "sqmm"
     target=intent["amp"] if key=="amp" else intent["sqmm"]
     if not target: return []
     al=[]
-    for p in catalog:
-        if intent["type"] not in str(p.get("type","")).lower(): continue
-        val=p.get(key)
-        if isinstance(val,(int,float)): al.append((abs(val-target), p))
-    al.sort(key=lambda x:x[0]); return [p for _,p in al[:limit]]
+    for t,(vals,slots) in snap.index.get("nearest",{}).get(key,{}).items():
+        if intent["type"] in t: al+=_closest(vals, slots, target, limit)
+    al.sort(); return [snap.items[i] for _,i in al[:limit]]
 
 # ───────────── Доп. фильтрация для мастера (НОВОЕ) ─────────────
 def _norm(s):
     return re.sub(r"\s+", " ", str(s or "")).strip().lower()
 
-def filter_items_by_advanced(category: str, selections: OrderedDict) -> list[dict]:
-    """
-    Фильтрует товары по категории + выбранным атрибутам (мастер фильтров).
-    Поддерживает: точное совпадение атрибута, мягкий матч по подстроке, "Бренд", "Наличие".
-    """
-    if not catalog:
-        return []
-
-    want_cat = (_norm(category) if category else "")
-    sel = selections or OrderedDict()
-
-    want_brand = _norm(sel.get("Бренд", ""))
-    want_avail = (sel.get("Наличие", "") or "").strip().lower()
-    attr_pairs = [(k, str(v)) for k, v in sel.items() if k not in ("Бренд", "Наличие")]
-
-    def ok_availability(p):
-        if not want_avail:
-            return True
-        stock = p.get("stock")
-        if not isinstance(stock, (int, float)):
-            return want_avail not in ("в наличии", "под заказ")
-        return (want_avail == "в наличии" and stock > 0) or (want_avail == "под заказ" and stock <= 0)
-
-    def ok_brand(p):
-        if not want_brand:
-            return True
-        return want_brand in _norm(p.get("brand"))
-
-    def ok_attrs(p):
-        if not attr_pairs:
-            return True
-        p_attrs = { _normalize_attr_name(k): str(v) for k, v in (p.get("attrs") or {}).items() }
-        for ak, av in attr_pairs:
-            ak_norm = _normalize_attr_name(ak)
-            pv = str(p_attrs.get(ak_norm, ""))
-            if _norm(av) not in _norm(pv):
-                return False
-        return True
-
-    res = []
-    for it in catalog:
-        if want_cat and _norm(it.get("category")) != want_cat:
-            continue
-        if not ok_brand(it):
-            continue
-        if not ok_availability(it):
-            continue
-        if not ok_attrs(it):
-            continue
-        res.append(it)
+def _sel_posting(f, an, val):
+    # товары категории (её фасеты f) под один выбор мастера; None — выбор ничего не ограничивает
+    if an == "Бренд":
+        want = _norm(val)
+        return _union([s for b, s in f.get("brand", {}).items() if want in b]) if want else None
+    if an == "Наличие":
+        want = (val or "").strip().lower()
+        if not want: return None
+        return f.get("avail", {}).get({"в наличии": "in", "под заказ": "out"}.get(want, "unknown"), ())
+    want = _norm(val)
+    if not want: return None
+    vals = f.get("attrs", {}).get(_normalize_attr_name(an), {})
+    return _union([s for v, s in vals.items() if want in v])
+
+def _rank_found(snap, found) -> list[dict]:
+    res = [snap.items[i] for i in sorted(found)]
 
     def _key(p):
         stock = p.get("stock")
@@ -655,13 +2092,73 @@ def filter_items_by_advanced(category: str, selections: OrderedDict) -> list[dic
     return res
 
 # ───────────── ФИЛЬТРЫ (Stateful Wizard v2) ─────────────
-WIZ2 = {}  # key=(chat_id, msg_id) → {"cat": str_slug, "i": int, "sel": OrderedDict()}
+WIZ2 = session_store("Мастер фильтров")  # key=(chat_id, msg_id) → {"cat": str_slug, "i": int, "sel": OrderedDict()}
+# промежуточные множества мастера (на диск не сохраняются — позиции живут до смены снапшота):
+# key → {"ver", "cat", "chain": [((атрибут, значение), array позиций), ...], "vals": {(выборы, атрибут): [(значение, n)]}}
+WIZ2_CAND = session_store("Кандидаты мастера", max_bytes=int(WIZ_CAND_MAX_MB * 1048576))
+
+def wizard_candidates(key, cat, sel, snap=None):
+    return _wiz_narrow(key, cat, sel, snap)[0]
+
+def _wiz_narrow(key, cat, sel, snap=None):
+    """
+    Позиции товаров категории, подходящих под выборы мастера. На сессию хранится
+    цепочка сужений в порядке выбора: новый выбор пересекается только с последним
+    множеством, а «Назад»/смена значения обрезают цепочку до общего префикса.
+    """
+    snap = snap or _snapshot
+    f = snap.index.get("facets", {}).get(_norm(cat)) or {}
+    c = WIZ2_CAND.get(key)
+    if c is None or c["ver"] != snap.version or c["cat"] != cat:
+        c = {"ver": snap.version, "cat": cat, "chain": [], "vals": {}}
+    picks = list(sel.items()); chain = c["chain"]; n = 0
+    while n < len(chain) and n < len(picks) and chain[n][0] == picks[n]: n += 1
+    del chain[n:]
+    cur = chain[-1][1] if chain else f.get("all", array("I"))
+    for pick in picks[n:]:
+        post = _sel_posting(f, *pick)
+        # оба множества обычно соизмеримы — пересечение set'ами дешевле бинарного поиска по каждому
+        if post is not None: cur = array("I", sorted(set(cur).intersection(post)))
+        chain.append((pick, cur))
+    # заново — чтобы хранилище пересчитало размер; запись больше max_bytes оно сразу
+    # вытеснит, поэтому вызывающие работают с возвращённым c, а не перечитывают store
+    WIZ2_CAND[key] = c
+    return cur, c
+
+def wizard_values(key, cat, i, sel, snap=None) -> list:
+    # [(значение, сколько товаров останется)] для шага i — только по товарам, прошедшим
+    # остальные выборы; нулевые скрыты, частые первыми, не больше VALUES_PER_STEP
+    snap = snap or _snapshot
+    steps = _cat_steps(cat)
+    if not 0 <= i < len(steps): return []
+    an = steps[i]
+    # свой же выбор шага (после «Назад») не сужает собственные значения
+    rest = OrderedDict((k, v) for k, v in sel.items() if k != an)
+    cur, c = _wiz_narrow(key, cat, rest, snap)
+    vk = (tuple(rest.items()), an)
+    got = c["vals"].get(vk)
+    if got is None:
+        f = snap.index.get("facets", {}).get(_norm(cat)) or {}
+        # вся категория — счётчик равен длине posting; иначе пересечение по set на C-скорости
+        cs = None if cur is f.get("all") else set(cur)
+        got = []
+        for v in _cat_attr_values(cat, an):
+            post = _sel_posting(f, an, v)
+            n = len(cur) if post is None else (len(post) if cs is None else len(cs.intersection(post)))
+            if n: got.append((v, n))
+        got.sort(key=lambda x: -x[1])   # sort стабилен: при равенстве — порядок по каталогу
+        del got[VALUES_PER_STEP:]
+        if len(c["vals"]) >= 32: c["vals"].clear()
+        c["vals"][vk] = got
+        WIZ2_CAND[key] = c
+    return got
 
 def _cat_steps(cat):
-    return catalog_index.get("attr_steps_by_cat", {}).get(cat, [])
+    return _snapshot.index.get("attr_steps_by_cat", {}).get(cat, [])
 
 def _cat_attr_values(cat, attr):
-    return [v for v,_ in catalog_index.get("attrs_by_cat", {}).get(cat, {}).get(attr, Counter()).most_common()]
+    return rendered(("attr_values", cat, attr), lambda: [
+        v for v,_ in _snapshot.index.get("attrs_by_cat", {}).get(cat, {}).get(attr, Counter()).most_common()])
 
 def _w2_key_from_cq(cq):
     return (cq.message.chat.id, cq.message.id)
@@ -673,28 +2170,32 @@ def _w2_set(key, data):
     WIZ2[key] = data
 
 def build_cat_list_kb(page: int = 1):
-    cats = catalog_index.get("categories", [])
+    return rendered(("cats", page), lambda: _build_cat_list_kb(page))
+
+def _build_cat_list_kb(page):
+    cats = _snapshot.index.get("categories", [])
     total = len(cats)
     if total == 0:
-        return InlineKeyboardMarkup([[InlineKeyboardButton("Обновить каталог", callback_data="cats:refresh")]])
+        return InlineKeyboardMarkup([[InlineKeyboardButton("Обновить каталог", callback_data=cb("cr"))]])
     pages = max(1, (total + CAT_PAGE - 1) // CAT_PAGE)
     page = max(1, min(page, pages))
     start = (page - 1) * CAT_PAGE
     chunk = cats[start:start+CAT_PAGE]
     rows = []
     for c in chunk:
-        rows.append([InlineKeyboardButton(f"{c}", callback_data=f"fw2start:{slugify(c)}")])
+        rows.append([InlineKeyboardButton(f"{c}", callback_data=cb("w", cb_slug(c)))])
     nav = []
-    if page > 1: nav.append(InlineKeyboardButton("« Назад", callback_data=f"cats:p:{page-1}"))
-    if page < pages: nav.append(InlineKeyboardButton("Вперёд »", callback_data=f"cats:p:{page+1}"))
+    if page > 1: nav.append(InlineKeyboardButton("« Назад", callback_data=cb("c", page-1)))
+    if page < pages: nav.append(InlineKeyboardButton("Вперёд »", callback_data=cb("c", page+1)))
     if nav: rows.append(nav)
     return InlineKeyboardMarkup(rows)
 
-def wizard2_text(cat_slug: str, i: int, selections: OrderedDict):
+def wizard2_text(cat_slug: str, i: int, selections: OrderedDict, key=None):
     cat = unslugify(cat_slug)
     steps = _cat_steps(cat)
     lines = [f"📂 Категория: <b>{cat}</b>",
-             "Выбирайте параметры. Можно «Пропустить» любой шаг или нажать «Показать сейчас ✅» в любой момент."]
+             "Выбирайте параметры. Можно «Пропустить» любой шаг или нажать «Показать сейчас ✅» в любой момент.",
+             f"Подходит товаров: <b>{len(wizard_candidates(key, cat, selections))}</b>"]
     if steps:
         for idx, an in enumerate(steps):
             mark = "✅" if an in selections else "—"
@@ -705,71 +2206,65 @@ def wizard2_text(cat_slug: str, i: int, selections: OrderedDict):
         lines.append("<i>Для этой категории нет атрибутов.</i>")
     return "\n".join(lines)
 
-def kb_wizard2(cat_slug: str, i: int, selections: OrderedDict):
+def kb_wizard2(cat_slug: str, i: int, selections: OrderedDict, key=None):
     cat = unslugify(cat_slug)
     steps = _cat_steps(cat)
     rows = []
 
     if steps and 0 <= i < len(steps):
-        an = steps[i]
-        values = _cat_attr_values(cat, an)[:VALUES_PER_STEP]
+        values = wizard_values(key, cat, i, selections)
         if values:
-            for vidx, v in enumerate(values):
-                rows.append([InlineKeyboardButton(v, callback_data=f"fw2v:{i}:{vidx}")])
+            for vidx, (v, n) in enumerate(values):
+                rows.append([InlineKeyboardButton(f"{v} ({n})", callback_data=cb("wv", i, vidx))])
         else:
-            rows.append([InlineKeyboardButton("Нет значений", callback_data="noop")])
+            rows.append([InlineKeyboardButton("Нет значений", callback_data=cb("n"))])
 
         rows.append([
-            InlineKeyboardButton("Пропустить", callback_data=f"fw2skip:{i}"),
-            InlineKeyboardButton("Показать сейчас ✅", callback_data=f"fw2show")
+            InlineKeyboardButton("Пропустить", callback_data=cb("wk", i)),
+            InlineKeyboardButton("Показать сейчас ✅", callback_data=cb("wh"))
         ])
 
         nav = []
         if i > 0:
-            nav.append(InlineKeyboardButton("← Назад", callback_data=f"fw2back:{i}"))
-        nav.append(InlineKeyboardButton("Сбросить", callback_data=f"fw2reset"))
+            nav.append(InlineKeyboardButton("← Назад", callback_data=cb("wb", i)))
+        nav.append(InlineKeyboardButton("Сбросить", callback_data=cb("wr")))
         rows.append(nav)
     else:
-        rows.append([InlineKeyboardButton("✅ Показать товары", callback_data=f"fw2show")])
-        rows.append([InlineKeyboardButton("← К категориям", callback_data="cats:p:1")])
+        rows.append([InlineKeyboardButton("✅ Показать товары", callback_data=cb("wh"))])
+        rows.append([InlineKeyboardButton("← К категориям", callback_data=cb("c", 1))])
 
-    rows.append([InlineKeyboardButton("← Категории", callback_data="cats:p:1")])
+    rows.append([InlineKeyboardButton("← Категории", callback_data=cb("c", 1))])
     return InlineKeyboardMarkup(rows)
 
-def wizard2_edit_message(cq):
+async def wizard2_edit_message(cq):
     key = _w2_key_from_cq(cq)
     state = _w2_get(None, key=key)
     if not state:
         return
-    txt = wizard2_text(state["cat"], state["i"], state["sel"])
-    kb  = kb_wizard2(state["cat"], state["i"], state["sel"])
+    # экран зависит только от категории, шага и выборов — общий для всех сессий
+    txt, kb = rendered(("wiz", state["cat"], state["i"], tuple(state["sel"].items())),
+                       lambda: (wizard2_text(state["cat"], state["i"], state["sel"], key),
+                                kb_wizard2(state["cat"], state["i"], state["sel"], key)))
     try:
-        cq.message.edit_text(txt, reply_markup=kb)
+        await tg(cq.message.edit_text, txt, reply_markup=kb)
     except Exception:
-        cq.message.reply_text(txt, reply_markup=kb)
+        await tg(cq.message.reply_text, txt, reply_markup=kb)
 
-def wizard2_show_results(cq):
+async def wizard2_show_results(cq):
     key = _w2_key_from_cq(cq)
     state = _w2_get(None, key=key)
     if not state:
         return
     cat = unslugify(state["cat"])
     selections = state["sel"]
-    items = filter_items_by_advanced(cat, selections)
+    snap = _snapshot
+    items = _rank_found(snap, wizard_candidates(key, cat, selections, snap))
     header = f"📦 Результаты для «{cat}»"
     if selections:
         pretty = ", ".join([f"{k}: {v}" for k,v in selections.items()])
         header += f"\nФильтры: {pretty}"
-    header += f"\nНайдено: {len(items)} шт."
-    try:
-        cq.message.edit_text(header)
-    except Exception:
-        cq.message.reply_text(header)
-    for p in items[:20]:
-        try: send_product_message(cq.message, p)
-        except Exception: traceback.print_exc()
-    if len(items) > 20:
-        cq.message.reply_text(f"Показаны первые 20 из {len(items)}. Уточни фильтры или используй поиск.")
+    # отдельным сообщением: мастер остаётся, выбор можно уточнить
+    await send_results(cq.message, header, items)
 
 # ───────────── Pyrogram ─────────────
 app = Client(
@@ -777,7 +2272,7 @@ app = Client(
     bot_token=BOT_TOKEN,
     api_id=API_ID,
     api_hash=API_HASH,
-    in_memory=True,
+    workdir=STATE_DIR,   # файл сессии: без повторной авторизации на каждом рестарте
     parse_mode=ParseMode.HTML
 )
 
@@ -793,190 +2288,257 @@ def reply_main_keyboard(user_id: int) -> ReplyKeyboardMarkup:
     return ReplyKeyboardMarkup(rows, resize_keyboard=True)
 
 @app.on_message(filters.private & filters.command("start"))
-def start_handler(_, message):
+async def start_handler(_, message):
     uid = message.from_user.id
     chat_history[uid] = []
     kb_main = reply_main_keyboard(uid)
-    message.reply_text(
+    await tg(message.reply_text,
         "Привет! Я бот магазина ⚡ Выбирай «📂 Категории» → фильтры по шагам (в одном сообщении), "
         "или пиши свободно: «контактор 25А катушка 220В IP20».",
         reply_markup=kb_main
     )
     kb_inline = InlineKeyboardMarkup([
-        [InlineKeyboardButton("📂 Открыть категории", callback_data="cats:p:1")]
+        [InlineKeyboardButton("📂 Открыть категории", callback_data=cb("c", 1))]
     ])
-    message.reply_text("Быстрое меню:", reply_markup=kb_inline)
+    await tg(message.reply_text, "Быстрое меню:", reply_markup=kb_inline)
 
 @app.on_message(filters.private & filters.text & filters.regex(r"^(🏠 Старт|Старт|Меню|Главное меню)$"))
-def start_button_handler(_, message):
-    return start_handler(_, message)
+async def start_button_handler(_, message):
+    return await start_handler(_, message)
 
 @app.on_message(filters.private & filters.command("help"))
-def help_handler(_, message):
-    message.reply_text("Категории → мастер фильтров по шагам (в одном сообщении). Можно «Пропустить» шаг или «Показать сейчас». Кнопка «🏠 Старт» — главное меню.")
+async def help_handler(_, message):
+    await tg(message.reply_text, "Категории → мастер фильтров по шагам (в одном сообщении). Можно «Пропустить» шаг или «Показать сейчас». Кнопка «🏠 Старт» — главное меню.")
 
-def show_catalog(_, message):
-    if not catalog: message.reply_text("Каталог пока пуст, попробуйте позже."); return
-    for p in catalog[:10]:
-        try: send_product_message(message, p)
-        except Exception: traceback.print_exc()
+async def show_catalog(_, message):
+    items = _snapshot.items
+    if not items: await tg(message.reply_text, "Каталог пока пуст, попробуйте позже."); return
+    await send_results(message, "📦 Каталог", items)
 
 @app.on_message(filters.private & filters.command("catalog"))
-def catalog_cmd(_, message): show_catalog(_, message)
+async def catalog_cmd(_, message): await show_catalog(_, message)
 
 @app.on_message(filters.private & filters.command("find"))
-def find_cmd(_, message):
-    query=" ".join(message.command[1:]).strip(); handle_search_text(_, message, query)
-
-def handle_search_text(_, message, text):
-    if not text: message.reply_text("Что ищем? Например: контактор 25А катушка 220В IP20."); return
-    if not catalog: message.reply_text("Каталог пока не загружен."); return
-    results=search_products_smart(text, limit=10)
+async def find_cmd(_, message):
+    query=" ".join(message.command[1:]).strip(); await handle_search_text(_, message, query)
+
+async def handle_search_text(_, message, text):
+    if not text: await tg(message.reply_text, "Что ищем? Например: контактор 25А катушка 220В IP20."); return
+    snap=_snapshot
+    if not snap.items: await tg(message.reply_text, "Каталог пока не загружен."); return
+    results=search_products_smart(text, limit=10, snap=snap)
     if results:
-        for p in results:
-            try: send_product_message(message, p)
-            except Exception: traceback.print_exc()
-        return
-    intent=parse_intent(text); alts=suggest_alternatives(intent, limit=6)
+        await send_results(message, f"🔎 «{html.escape(text)}»", results); return
+    intent=parse_intent(text, snap); alts=suggest_alternatives(intent, limit=6, snap=snap)
     if alts:
-        message.reply_text("Похожее по параметрам:")
-        for p in alts:
-            try: send_product_message(message, p)
-            except Exception: traceback.print_exc()
-        return
-    message.reply_text("Ничего не нашлось 😕 Уточни запрос или открой «📂 Категории».")
+        await send_results(message, "Похожее по параметрам:", alts); return
+    await tg(message.reply_text, "Ничего не нашлось 😕 Уточни запрос или открой «📂 Категории».")
 
 # ───────────── Callback’и ─────────────
 @app.on_callback_query()
-def callbacks_handler(client, cq):
+async def callbacks_handler(client, cq):
+    # диспетчер: op до первого «:» → обработчик из _CALLBACKS, аргументы разбираются по его convs
     try:
-        data=cq.data or ""
-
-        # Бронирование товара (НОВОЕ)
-        if data.startswith("reserve:"):
-            pid = data.split(":", 1)[1]
-            user_id = cq.from_user.id
-            pending_reserve[user_id] = pid
-            try:
-                cq.message.reply_text(
-                    "Окей! Отправьте, пожалуйста, номер телефона для связи 📞\n"
-                    "Пример: +7 999 123-45-67"
-                )
-            except Exception:
-                traceback.print_exc()
-            return cq.answer("Жду номер телефона")
-
-        # Категории/пагинация
-        if data.startswith("cats:"):
-            if data == "cats:refresh":
-                ok = fetch_catalog(force=True)
-                try: cq.message.edit_text("✅ Каталог обновлён" if ok else "❌ Не удалось обновить каталог")
-                except Exception: cq.message.reply_text("✅ Каталог обновлён" if ok else "❌ Не удалось обновить каталог")
-                return cq.answer()
-            m = re.search(r"cats:p:(\d+)", data)
-            page = int(m.group(1)) if m else 1
-            txt = "Категории:"
-            kb = build_cat_list_kb(page)
-            try: cq.message.edit_text(txt, reply_markup=kb)
-            except Exception: cq.message.reply_text(txt, reply_markup=kb)
-            return cq.answer()
-
-        # ── Новый мастер фильтров (короткие колбэки) ──
-        if data.startswith("fw2start:"):
-            cat_slug = data.split(":",1)[1]
-            key = (cq.message.chat.id, cq.message.id)
-            _w2_set(key, {"cat": cat_slug, "i": 0, "sel": OrderedDict()})
-            wizard2_edit_message(cq)
-            return cq.answer()
-
-        if data.startswith("fw2v:"):
-            try:
-                _, aidx, vidx = data.split(":")
-                aidx = int(aidx); vidx = int(vidx)
-            except Exception:
-                return cq.answer()
-            key = _w2_key_from_cq(cq); st = _w2_get(None, key=key)
-            if not st: return cq.answer()
-            cat = unslugify(st["cat"]); steps = _cat_steps(cat)
-            if not steps or aidx<0 or aidx>=len(steps): return cq.answer()
-            an = steps[aidx]
-            values = _cat_attr_values(cat, an)[:VALUES_PER_STEP]
-            if not values or vidx<0 or vidx>=len(values): return cq.answer()
-            val = values[vidx]
-            st["sel"][an] = val
-            st["i"] = min(aidx+1, len(steps))
-            _w2_set(key, st)
-            wizard2_edit_message(cq)
-            return cq.answer()
-
-        if data.startswith("fw2skip:"):
-            try:
-                _, aidx = data.split(":")
-                aidx = int(aidx)
-            except Exception:
-                return cq.answer()
-            key = _w2_key_from_cq(cq); st = _w2_get(None, key=key)
-            if not st: return cq.answer()
-            cat = unslugify(st["cat"]); steps = _cat_steps(cat)
-            st["i"] = min(aidx+1, len(steps))
-            _w2_set(key, st)
-            wizard2_edit_message(cq)
-            return cq.answer()
-
-        if data.startswith("fw2back:"):
-            try:
-                _, aidx = data.split(":"); aidx = int(aidx)
-            except Exception:
-                return cq.answer()
-            key = _w2_key_from_cq(cq); st = _w2_get(None, key=key)
-            if not st: return cq.answer()
-            cat = unslugify(st["cat"]); steps = _cat_steps(cat)
-            prev_i = max(0, aidx-1)
-            if 0 <= aidx < len(steps):
-                st["sel"].pop(steps[aidx], None)
-            st["i"] = prev_i
-            _w2_set(key, st)
-            wizard2_edit_message(cq)
-            return cq.answer()
-
-        if data == "fw2reset":
-            key = _w2_key_from_cq(cq); st = _w2_get(None, key=key)
-            if not st: return cq.answer()
-            st["sel"].clear(); st["i"] = 0
-            _w2_set(key, st)
-            wizard2_edit_message(cq)
-            return cq.answer()
-
-        if data == "fw2show":
-            wizard2_show_results(cq)
-            return cq.answer()
-
-        if data == "noop":
-            return cq.answer()
+        op, _, rest = (cq.data or "").partition(":")
+        entry = _CALLBACKS.get(op)
+        if entry is None: return await cq.answer()
+        fn, convs = entry
+        args = rest.split(":") if rest else []
+        if convs is not None:
+            if len(args) != len(convs): return await cq.answer()
+            try: args = [c(a) for c, a in zip(convs, args)]
+            except ValueError: return await cq.answer()
+        await fn(cq, *args)
+    except Exception:
+        traceback.print_exc()
+        await cq.answer("Ошибка обработчика", show_alert=False)
 
+# Бронирование товара
+async def _reserve(cq, pid):
+    pending_reserve[cq.from_user.id] = pid
+    try:
+        await tg(cq.message.reply_text,
+            "Окей! Отправьте, пожалуйста, номер телефона для связи 📞\n"
+            "Пример: +7 999 123-45-67"
+        )
+    except Exception:
+        traceback.print_exc()
+    return await cq.answer("Жду номер телефона")
+
+@on_callback("r", str)
+async def cb_reserve(cq, slug):
+    pid = _snapshot.index.get("id_by_slug", {}).get(slug)
+    if pid is None: return await cq.answer("Товар больше не продаётся", show_alert=True)
+    return await _reserve(cq, pid)
+
+async def _reserve_legacy(cq, *parts):
+    # старые кнопки: id товара как есть, а в нём бывает «:»
+    return await _reserve(cq, ":".join(parts))
+
+_CALLBACKS["reserve"] = (_reserve_legacy, None)
+
+# Листание выдачи / карточка / фото страницы
+@on_callback("s", str, str, int)
+async def cb_results(cq, token, op, arg):
+    res = _results_get(token, cq.message.chat.id)
+    if res is None:
+        return await cq.answer("Результаты устарели — повторите поиск", show_alert=True)
+    if op == "p":
+        txt, kb = results_page(token, arg, cq.message.chat.id)
+        try: await tg(cq.message.edit_text, txt, reply_markup=kb)
+        except Exception: pass
+    elif op == "o":
+        items = res["items"]
+        if 0 <= arg < len(items): await send_product_message(cq.message, items[arg])
+    elif op == "g":
+        await send_results_photos(cq.message, token, arg)
+    return await cq.answer()
+
+# Категории/пагинация
+@on_callback("c", int)
+async def cb_cats(cq, page):
+    txt = "Категории:"
+    kb = build_cat_list_kb(page)
+    try: await tg(cq.message.edit_text, txt, reply_markup=kb)
+    except Exception: await tg(cq.message.reply_text, txt, reply_markup=kb)
+    return await cq.answer()
+
+@on_callback("cr")
+async def cb_cats_refresh(cq):
+    ok = await asyncio.to_thread(fetch_catalog, True)
+    try: await tg(cq.message.edit_text, "✅ Каталог обновлён" if ok else "❌ Не удалось обновить каталог")
+    except Exception: await tg(cq.message.reply_text, "✅ Каталог обновлён" if ok else "❌ Не удалось обновить каталог")
+    return await cq.answer()
+
+async def _cats_legacy(cq, *args):
+    # «cats:refresh» / «cats:p:N»
+    if args == ("refresh",): return await cb_cats_refresh(cq)
+    page = int(args[1]) if len(args) == 2 and args[0] == "p" and args[1].isdigit() else 1
+    return await cb_cats(cq, page)
+
+_CALLBACKS["cats"] = (_cats_legacy, None)
+
+# ── Мастер фильтров ──
+@on_callback("w", str, legacy="fw2start")
+async def cb_wizard_start(cq, cat_slug):
+    key = (cq.message.chat.id, cq.message.id)
+    _w2_set(key, {"cat": cat_slug, "i": 0, "sel": OrderedDict()})
+    await wizard2_edit_message(cq)
+    return await cq.answer()
+
+@on_callback("wv", int, int, legacy="fw2v")
+async def cb_wizard_value(cq, aidx, vidx):
+    key = _w2_key_from_cq(cq); st = _w2_get(None, key=key)
+    if not st: return await cq.answer()
+    cat = unslugify(st["cat"]); steps = _cat_steps(cat)
+    if not steps or aidx<0 or aidx>=len(steps): return await cq.answer()
+    an = steps[aidx]
+    values = [v for v, _ in wizard_values(key, cat, aidx, st["sel"])]
+    if not values or vidx<0 or vidx>=len(values): return await cq.answer()
+    val = values[vidx]
+    st["sel"][an] = val
+    st["i"] = min(aidx+1, len(steps))
+    _w2_set(key, st)
+    await wizard2_edit_message(cq)
+    return await cq.answer()
+
+@on_callback("wk", int, legacy="fw2skip")
+async def cb_wizard_skip(cq, aidx):
+    key = _w2_key_from_cq(cq); st = _w2_get(None, key=key)
+    if not st: return await cq.answer()
+    cat = unslugify(st["cat"]); steps = _cat_steps(cat)
+    st["i"] = min(aidx+1, len(steps))
+    _w2_set(key, st)
+    await wizard2_edit_message(cq)
+    return await cq.answer()
+
+@on_callback("wb", int, legacy="fw2back")
+async def cb_wizard_back(cq, aidx):
+    key = _w2_key_from_cq(cq); st = _w2_get(None, key=key)
+    if not st: return await cq.answer()
+    cat = unslugify(st["cat"]); steps = _cat_steps(cat)
+    prev_i = max(0, aidx-1)
+    if 0 <= aidx < len(steps):
+        st["sel"].pop(steps[aidx], None)
+    st["i"] = prev_i
+    _w2_set(key, st)
+    await wizard2_edit_message(cq)
+    return await cq.answer()
+
+@on_callback("wr", legacy="fw2reset")
+async def cb_wizard_reset(cq):
+    key = _w2_key_from_cq(cq); st = _w2_get(None, key=key)
+    if not st: return await cq.answer()
+    st["sel"].clear(); st["i"] = 0
+    _w2_set(key, st)
+    await wizard2_edit_message(cq)
+    return await cq.answer()
+
+@on_callback("wh", legacy="fw2show")
+async def cb_wizard_show(cq):
+    await wizard2_show_results(cq)
+    return await cq.answer()
+
+@on_callback("n", legacy="noop")
+async def cb_noop(cq):
+    return await cq.answer()
+
+# ───────────── Inline-поиск ─────────────
+def _inline_result(p, rid):
+    caption = product_caption(p); kb = product_keyboard(p, inline=True)
+    price = p.get("price")
+    desc = f"Арт. {p.get('sku') or '—'} · " + (f"{_fmt_price(price)} ₽" if price is not None else "цена по запросу")
+    img = p.get("image_url")
+    if img:
+        cached = photo_file_ids.get(str(p.get("id") or p.get("sku")))
+        if cached and cached[0] == img:
+            return InlineQueryResultCachedPhoto(cached[1], id=rid, title=p.get("name",""), description=desc,
+                                                caption=caption, reply_markup=kb)
+        return InlineQueryResultPhoto(img, thumb_url=img, id=rid, title=p.get("name",""), description=desc,
+                                      caption=caption, reply_markup=kb)
+    return InlineQueryResultArticle(p.get("name","") or "Товар", InputTextMessageContent(caption),
+                                    id=rid, description=desc, reply_markup=kb)
+
+@app.on_inline_query()
+async def inline_handler(_, iq):
+    try:
+        snap = _snapshot
+        try: offset = int(iq.offset or 0)
+        except ValueError: offset = 0
+        matches = inline_matches(iq.query, snap)
+        page = matches[offset:offset+INLINE_PAGE]
+        results = [_inline_result(snap.items[i], f"{snap.version}:{i}") for i in page]
+        nxt = str(offset+INLINE_PAGE) if offset+INLINE_PAGE < len(matches) else ""
+        await iq.answer(results, cache_time=INLINE_CACHE_TIME, next_offset=nxt)
     except Exception:
         traceback.print_exc()
-        cq.answer("Ошибка обработчика", show_alert=False)
 
 # /sync1c — только админ (и кнопка Reply «Обновить каталог»)
 @app.on_message(filters.private & (filters.command("sync1c") | filters.regex("^Обновить каталог$")))
-def sync1c_handler(_, message):
+async def sync1c_handler(_, message):
+    if TELEGRAM_ADMIN_ID and message.from_user.id != TELEGRAM_ADMIN_ID:
+        await tg(message.reply_text, "❌ Недостаточно прав."); return
+    ok=await asyncio.to_thread(fetch_catalog, True)
+    await tg(message.reply_text, "✅ Каталог обновлён" if ok else "❌ Не удалось обновить каталог, проверь логи.")
+
+# /stats — счётчики кэшей и сессий, только админ
+@app.on_message(filters.private & filters.command("stats"))
+async def stats_handler(_, message):
     if TELEGRAM_ADMIN_ID and message.from_user.id != TELEGRAM_ADMIN_ID:
-        message.reply_text("❌ Недостаточно прав."); return
-    ok=fetch_catalog(force=True)
-    message.reply_text("✅ Каталог обновлён" if ok else "❌ Не удалось обновить каталог, проверь логи.")
+        await tg(message.reply_text, "❌ Недостаточно прав."); return
+    await tg(message.reply_text, "📊 Сессии и кэши:\n" + "\n".join("• " + html.escape(st.stats()) for st in SESSION_STORES)
+             + f"\n• {reservations.stats()}"
+             + f"\n• Запросов в OpenRouter: {llm_upstream}, склеено одновременных: {llm_coalesced}")
 
 # Сбор телефона для брони
-@app.on_message(filters.private & filters.text & ~filters.command(["start","reset","img","catalog","find","sync1c","help"]))
-def maybe_collect_phone(_, message):
+@app.on_message(filters.private & filters.text & ~filters.command(["start","reset","img","catalog","find","sync1c","help","stats"]))
+async def maybe_collect_phone(_, message):
     uid=message.from_user.id
     if uid in pending_reserve:
         pid=pending_reserve.get(uid); phone=(message.text or "").strip()
         if not PHONE_RE.match(phone):
-            message.reply_text("Похоже, номер не распознан. Пример: +7 999 123-45-67\nОтправьте номер ещё раз."); return
-        product=None
-        for p in catalog:
-            if p.get("id")==pid or p.get("sku")==pid: product=p; break
+            await tg(message.reply_text, "Похоже, номер не распознан. Пример: +7 999 123-45-67\nОтправьте номер ещё раз."); return
+        product=find_product(pid)
         text=("🧾 Новая бронь:\n"
               f"Пользователь: @{message.from_user.username or message.from_user.id}\n"
               f"Телефон: {phone}\n"
@@ -984,90 +2546,119 @@ def maybe_collect_phone(_, message):
               f"SKU: {product.get('sku','—') if product else '—'}\n"
               f"Цена: {product.get('price','—') if product else '—'} ₽")
         pending_reserve.pop(uid, None)
-        if MANAGER_CHAT_ID:
-            try: _.send_message(MANAGER_CHAT_ID, text)
-            except Exception: traceback.print_exc()
-        message.reply_text("Спасибо! Менеджер скоро свяжется для подтверждения 😊")
+        # в журнал на диск и сразу ответ; менеджеру бронь доставит фоновая задача
+        if MANAGER_CHAT_ID: await reservations.submit(text)
+        await tg(message.reply_text, "Спасибо! Менеджер скоро свяжется для подтверждения 😊")
         return
 
 # /img
 @app.on_message(filters.private & filters.command("img"))
-def image_handler(_, message):
+async def image_handler(_, message):
     raw=" ".join(message.command[1:]).strip()
-    if not raw: message.reply_text("Напиши: /img кот в космосе --no текст, подписи"); return
+    if not raw: await tg(message.reply_text, "Напиши: /img кот в космосе --no текст, подписи"); return
     user_neg=""
     if "--no" in raw:
         parts=raw.split("--no",1); raw=parts[0].strip(); user_neg=parts[1].strip()
-    prompt_src=raw; prompt_en=translate_to_english(raw) if has_cyrillic(raw) else raw
+    prompt_src=raw; prompt_en=await translate_to_english(raw) if has_cyrillic(raw) else raw
     pos_prompt, neg_prompt = boost_prompt(prompt_en, user_negative=user_neg)
     try:
         model=(HF_IMAGE_MODEL or "stabilityai/sdxl-turbo").strip()
-        url=f"https://api-inference.huggingface.co/models/{model}"
+        url=f"{HF_API_URL}/{model}"
         headers={"Authorization": f"Bearer {HF_TOKEN}", "Accept":"image/png"}
         payload={"inputs":pos_prompt,"parameters":{"negative_prompt":neg_prompt,"num_inference_steps":24,"guidance_scale":7.0},"options":{"wait_for_model":True}}
-        resp=requests.post(url, headers=headers, json=payload, timeout=180); ct=resp.headers.get("content-type","")
-        if resp.status_code==200 and ct.startswith("image/"):
-            bio=BytesIO(resp.content); bio.name="image.png"
-            message.reply_photo(bio, caption=f"🎨 По запросу: {prompt_src or prompt_en}"); return
-        if resp.status_code in (429,503): message.reply_text("Модель занята или лимит. Попробуйте ещё раз позже ⏳"); return
-        snippet=(getattr(resp,"text","") or "")[:800]; message.reply_text(f"❌ Hugging Face {resp.status_code}\n{snippet}")
+        async with http_session().post(url, headers=headers, json=payload, timeout=aiohttp.ClientTimeout(total=180)) as resp:
+            ct=resp.headers.get("content-type",""); status=resp.status
+            body=await resp.read()
+        if status==200 and ct.startswith("image/"):
+            bio=BytesIO(body); bio.name="image.png"
+            await tg(message.reply_photo, bio, caption=f"🎨 По запросу: {prompt_src or prompt_en}"); return
+        if status in (429,503): await tg(message.reply_text, "Модель занята или лимит. Попробуйте ещё раз позже ⏳"); return
+        snippet=body.decode("utf-8", "replace")[:800]; await tg(message.reply_text, f"❌ Hugging Face {status}\n{snippet}")
     except Exception:
-        traceback.print_exc(); message.reply_text("Ошибка при генерации изображения 🎨")
+        traceback.print_exc(); await tg(message.reply_text, "Ошибка при генерации изображения 🎨")
+
+# ───────────── Ответы LLM ─────────────
+# Одинаковые первые вопросы («что такое УЗО», часы работы) не должны каждый раз
+# идти в OpenRouter: ответ кэшируется по нормализованной переписке и модели,
+# а одновременные одинаковые вопросы ждут один общий запрос (single-flight).
+LLM_SYSTEM_PROMPT = "Ты — бот магазина электрооборудования. Сначала помогай по каталогу, если не получается — отвечай кратко и по делу."
+LLM_CACHE = session_store("Ответы LLM", max_items=LLM_CACHE_MAX, ttl=LLM_CACHE_TTL_MIN * 60)
+_llm_inflight = {}   # ключ -> asyncio.Task запроса, который уже идёт
+llm_upstream = llm_coalesced = 0
+
+def _llm_key(history) -> bytes:
+    norm = [(m["role"], " ".join(m["content"].lower().split())) for m in history]
+    return hashlib.blake2b(json.dumps([OR_MODEL, norm], ensure_ascii=False).encode(), digest_size=16).digest()
+
+async def _llm_fetch(key, history):
+    global llm_upstream
+    llm_upstream += 1
+    payload = {"model": OR_MODEL, "messages": [{"role": "system", "content": LLM_SYSTEM_PROMPT}, *history]}
+    async with http_session().post(OR_CHAT_URL, headers=or_headers("TelegramBotNLSearch"), json=payload,
+                                   timeout=aiohttp.ClientTimeout(total=60), allow_redirects=False) as resp:
+        if resp.status != 200: return None
+        data = await resp.json(content_type=None)
+    reply = data["choices"][0]["message"]["content"].strip()
+    if reply: LLM_CACHE[key] = reply   # пустые и ошибки не кэшируются
+    return reply or "🤖 (пустой ответ)"
+
+async def llm_reply(history):
+    # ответ на переписку history или None, если OpenRouter ответил не 200
+    global llm_coalesced
+    key = _llm_key(history)
+    hit = LLM_CACHE.get(key)
+    if hit is not None: return hit
+    task = _llm_inflight.get(key)
+    if task is None:
+        task = _llm_inflight[key] = asyncio.get_running_loop().create_task(_llm_fetch(key, list(history)))
+        task.add_done_callback(lambda _: _llm_inflight.pop(key, None))
+    else:
+        llm_coalesced += 1
+    # shield: отмена одного ожидающего не обрывает запрос остальным
+    return await asyncio.shield(task)
 
 # Текст (личка)
-@app.on_message(filters.private & filters.text & ~filters.command(["start","reset","img","catalog","find","sync1c","help"]), group=1)
-def text_handler(_, message):
+@app.on_message(filters.private & filters.text & ~filters.command(["start","reset","img","catalog","find","sync1c","help","stats"]), group=1)
+async def text_handler(_, message):
     uid=message.from_user.id; user_text=(message.text or "").strip(); low=user_text.lower()
     if low in ("🏠 старт","старт","меню","главное меню"):
-        return start_handler(_, message)
-    if low in ("📦 каталог","каталог"): return show_catalog(_, message)
+        return await start_handler(_, message)
+    if low in ("📦 каталог","каталог"): return await show_catalog(_, message)
     if low in ("📂 категории","категории"):
-        try: message.reply_text("Категории:", reply_markup=build_cat_list_kb(page=1))
-        except Exception: message.reply_text("Категории недоступны сейчас.")
+        try: await tg(message.reply_text, "Категории:", reply_markup=build_cat_list_kb(page=1))
+        except Exception: await tg(message.reply_text, "Категории недоступны сейчас.")
         return
-    if low in ("🔎 поиск","поиск"): message.reply_text("Что ищем? Пиши свободно: «контактор 25А катушка 220В IP20»."); return
+    if low in ("🔎 поиск","поиск"): await tg(message.reply_text, "Что ищем? Пиши свободно: «контактор 25А катушка 220В IP20»."); return
     if low in ("🧹 сброс","сброс"): 
         chat_history[uid]=[]
-        message.reply_text("🧹 Память очищена!")
+        await tg(message.reply_text, "🧹 Память очищена!")
         return
 
-    if catalog:
-        results=search_products_smart(user_text, limit=8)
+    snap=_snapshot
+    if snap.items:
+        results=search_products_smart(user_text, limit=8, snap=snap)
         if results:
-            for p in results:
-                try: send_product_message(message, p)
-                except Exception: traceback.print_exc()
-            return
-        intent=parse_intent(user_text); alts=suggest_alternatives(intent, limit=6)
+            await send_results(message, f"🔎 «{html.escape(user_text)}»", results); return
+        intent=parse_intent(user_text, snap); alts=suggest_alternatives(intent, limit=6, snap=snap)
         if alts:
-            message.reply_text("Похожее по параметрам:")
-            for p in alts:
-                try: send_product_message(message, p)
-                except Exception: traceback.print_exc()
-            return
+            await send_results(message, "Похожее по параметрам:", alts); return
 
     if re.search(r"\b(привет|здравствуй|здравствуйте|добрый день|hi|hello)\b", low):
-        message.reply_text("Привет! Открой «📂 Категории» и собери фильтры по шагам, или напиши, что нужно (пример: «контактор 25А катушка 220В»)."); return
+        await tg(message.reply_text, "Привет! Открой «📂 Категории» и собери фильтры по шагам, или напиши, что нужно (пример: «контактор 25А катушка 220В»)."); return
 
     chat_history[uid].append({"role":"user","content":user_text}); chat_history[uid]=clamp_history(chat_history[uid])
     try:
-        payload={"model":OR_MODEL,"messages":[
-            {"role":"system","content":"Ты — бот магазина электрооборудования. Сначала помогай по каталогу, если не получается — отвечай кратко и по делу."},
-            *chat_history[uid],
-        ]}
-        resp=requests.post("https://openrouter.ai/api/v1/chat/completions", headers=or_headers("TelegramBotNLSearch"),
-                           json=payload, timeout=60, allow_redirects=False)
-        if resp.status_code!=200: message.reply_text("Не понял запрос. Пример: «контактор 25А катушка 220В» или открой «📂 Категории»."); return
-        bot_reply=resp.json()["choices"][0]["message"]["content"].strip() or "🤖 (пустой ответ)"
+        bot_reply=await llm_reply(chat_history[uid])
+        if bot_reply is None: await tg(message.reply_text, "Не понял запрос. Пример: «контактор 25А катушка 220В» или открой «📂 Категории»."); return
         chat_history[uid].append({"role":"assistant","content":bot_reply}); chat_history[uid]=clamp_history(chat_history[uid])
-        message.reply_text(bot_reply)
+        await tg(message.reply_text, bot_reply)
     except Exception:
-        traceback.print_exc(); message.reply_text("Упс, не разобрал. Попробуй «📂 Категории» и фильтры.")
+        traceback.print_exc(); await tg(message.reply_text, "Упс, не разобрал. Попробуй «📂 Категории» и фильтры.")
 
 # Reset
 @app.on_message(filters.private & filters.command("reset"))
-def reset_handler(_, message):
-    chat_history[message.from_user.id]=[]; message.reply_text("🧹 Память очищена!")
+async def reset_handler(_, message):
+    chat_history[message.from_user.id]=[]; await tg(message.reply_text, "🧹 Память очищена!")
 
 # Завершение
 def _graceful_exit(sig, frame):
@@ -1081,7 +2672,11 @@ signal.signal(signal.SIGINT, _graceful_exit)
 if __name__ == "__main__":
     try:
         log.info("✅ Бот запускается...")
+        os.makedirs(STATE_DIR, exist_ok=True)
+        load_sessions()
+        reservations.load()
         app.start()  # СНАЧАЛА стартуем Pyrogram
+        if MANAGER_CHAT_ID and len(reservations): app.loop.call_soon_threadsafe(reservations.kick)
 
         # Логирование инфо о боте (НОВОЕ)
         try:
@@ -1090,11 +2685,14 @@ if __name__ == "__main__":
         except Exception:
             traceback.print_exc()
 
-        # После старта: загрузка каталога и таймер
+        # После старта: каталог с диска (перепроверка в фоне) или загрузка и таймер
         if CATALOG_URL:
-            if not fetch_catalog(force=True):
-                log.warning("Каталог не удалось загрузить на старте")
-            periodic_refresh()
+            if load_catalog_state():
+                threading.Thread(target=revalidate_catalog, daemon=True).start()
+            else:
+                if not fetch_catalog(force=True):
+                    log.warning("Каталог не удалось загрузить на старте")
+                periodic_refresh()
 
         # HTTP-хук
         threading.Thread(target=_run_http_server, daemon=True).start()
@@ -1106,6 +2704,12 @@ if __name__ == "__main__":
     finally:
         try: app.stop()
         except Exception: pass
+        try: asyncio.get_event_loop().run_until_complete(close_http_session())
+        except Exception: pass
+        save_photo_cache()
+        save_sessions()
+        reservations.close()
+        close_process_pool()
 
 
 